@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+#Indicate the path to SimExm here
+sys.path.append('/path/to/SimExm')
+import numpy as np
+from scipy import ndimage
+from src.output import save_as_tiff
+
+#Compares the write speed and file size of the TIFF output options
+#on a volume that looks like typical simulation output
+
+#####################################
+#-------  Benchmark parameters  ----#
+#####################################
+
+#Volume dimension (z, x, y) of the simulated stack
+volume_dim = (100, 512, 512)
+#Proportion of voxels containing fluorophores
+density = 1e-3
+#Number of times each setting is written, the best time is kept
+repeats = 3
+#(name, output parameters) to compare
+settings = [('uncompressed', {}),
+            ('uncompressed, tiles 256', {'tile_size': 256}),
+            ('zlib 1', {'compression': 'zlib', 'compression_level': 1}),
+            ('zlib 6', {'compression': 'zlib', 'compression_level': 6}),
+            ('zlib 9', {'compression': 'zlib', 'compression_level': 9}),
+            ('zlib 6, tiles 256', {'compression': 'zlib', 'compression_level': 6, 'tile_size': 256}),
+            ('zstd 3', {'compression': 'zstd', 'compression_level': 3}),
+            ('zstd 9', {'compression': 'zstd', 'compression_level': 9})]
+
+#####################################
+#-----------  Benchmark  -----------#
+#####################################
+
+#Sparse blurred spots over a dark background with shot noise
+np.random.seed(0)
+spots = (np.random.random(volume_dim) < density) * 2000.0
+volume = ndimage.gaussian_filter(spots, (2.0, 1.5, 1.5))
+volume = np.random.poisson(volume + 2.0)
+volume = np.clip(volume, 0, 255).astype(np.uint8)
+
+path = tempfile.mkdtemp() + '/'
+print "{:<28}{:>12}{:>10}{:>12}".format('setting', 'size (MB)', 'ratio', 'MB/s')
+try:
+    for name, params in settings:
+        try:
+            best = float('inf')
+            for _ in range(repeats):
+                start = time.time()
+                save_as_tiff(volume, path, 'benchmark', False, **params)
+                best = min(best, time.time() - start)
+        except ImportError as e:
+            print "{:<28}{}".format(name, e)
+            continue
+        size = os.path.getsize(path + 'benchmark.tiff')
+        print "{:<28}{:>12.1f}{:>10.2f}{:>12.1f}".format(name, size / 1e6, volume.nbytes / float(size),\
+                                                          volume.nbytes / 1e6 / best)
+finally:
+    shutil.rmtree(path)
@@ -32,12 +32,13 @@ Main script to run the simulation.
 """
 
 import argparse
+import itertools
 from configobj import ConfigObj, flatten_errors
 from validate import Validator
 from src.load import load_gt
 from src.labeling import label
-from src.optics import resolve
-from src.output import save, save_gt
+from src.optics import resolve_channels, scaled_shape
+from src.output import save_gt, ChannelWriter, BackgroundTask, check_compression
 from tifffile import imshow
 import numpy as np
 import matplotlib
@@ -54,6 +55,8 @@ def run(config, show_output = False):
         show_output: boolean
             if True, shows the output in a new window
     """
+    #Fail early on output parameters which could only be caught when saving
+    check_compression(**config['output'])
     gt_params = config['groundtruth']
     volume_dim = gt_params['bounds']
     voxel_dim = gt_params['voxel_dim']
@@ -67,16 +70,34 @@ def run(config, show_output = False):
     labeling_params = config['labeling']
     labeled_volumes, labeled_cells = label(gt_dataset, volume_dim, voxel_dim, labeling_params)
 
-    print "Imaging..."
+    print "Imaging and saving..."
     expansion_params = config['expansion']
     optics_params = config['optics']
-    volumes = resolve(labeled_volumes, volume_dim, voxel_dim, expansion_params, optics_params)
-    print "Saving..."
-    #Save to desired output
     output_params = config['output']
-    save(volumes, **output_params)
-    save_gt(gt_dataset, labeled_cells, volume_dim, volumes[0].shape, voxel_dim,\
-            expansion_params, optics_params, **output_params)
+    out_dim = scaled_shape(volume_dim, voxel_dim, expansion_params['factor'], **optics_params)
+    #Ground truth is saved while imaging, and each channel as soon as it is resolved
+    gt_writer = BackgroundTask(save_gt, gt_dataset, labeled_cells, volume_dim, out_dim, voxel_dim,\
+                               expansion_params, optics_params, **output_params)
+    writer = ChannelWriter(**output_params)
+    channels = resolve_channels(labeled_volumes, volume_dim, voxel_dim, expansion_params,\
+                                optics_params)
+    if optics_params.get('processes', 1) != 1:
+        #Worker processes are forked when the first channel is requested. Writer threads
+        #are only started afterwards, so that none of them holds a lock while forking
+        first = list(itertools.islice(channels, 1))
+        channels = itertools.chain(first, channels)
+        del first
+    gt_writer.start()
+    writer.start()
+    volumes = []
+    for volume in channels:
+        writer.put(volume)
+        #Only keep the volumes if they are shown at the end
+        if show_output:
+            volumes.append(volume)
+        del volume
+    writer.close()
+    gt_writer.join()
     print "Done!"
     if show_output:
         imshow(np.moveaxis(np.array(volumes), 0, 3))
@@ -0,0 +1,439 @@
+# Provided under BSD license
+# Copyright (c) 2017, Jeremy Wohlwend
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#  - Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  - Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#  - Neither the name of SimExm nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without specific
+#    prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JEREMY WOHLWEND BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+_psf_numpy.py
+
+Pure NumPy implementation of the _psf C extension module used by psf.py,
+imported instead of it when the compiled extension is missing.
+Functions take the same arguments and return the same values as their
+counterparts in psf.c, but work on whole arrays at once: the Richards-Wolf
+integrals are computed for all (z, r) points as matrix products over the
+integration steps.
+"""
+
+from __future__ import division
+
+import math
+import numpy as np
+
+__version__ = '2015.03.19'
+
+#Lookup table of the Bessel functions of the first kind, see bessel_lut
+BESSEL_LEN = 1001
+BESSEL_RES = 10.0
+BESSEL_INT = 60
+
+def bessel_lut():
+    """
+    Returns the lookup table of the Bessel functions of orders 0, 1 and 2,
+    sampled every 1 / BESSEL_RES, computed by integrating Bessel's integral
+    with the same steps as psf.c.
+
+    Returns:
+        lut: numpy 2D float64 array
+            the values of each order at each sample, of shape (BESSEL_LEN, 3)
+    """
+    x = np.arange(BESSEL_LEN)[:, np.newaxis] / BESSEL_RES
+    lut = np.empty((BESSEL_LEN, 3))
+    t = np.arange(BESSEL_INT) * (math.pi / BESSEL_INT)
+    lut[:, 0] = np.cos(-x * np.sin(t)).sum(axis=1) / BESSEL_INT
+    lut[:, 2] = np.cos(2.0 * t - x * np.sin(t)).sum(axis=1) / BESSEL_INT
+    t = np.arange(BESSEL_INT) * (math.pi / (BESSEL_INT - 1))
+    lut[:, 1] = np.cos(t - x * np.sin(t)).sum(axis=1) / (BESSEL_INT - 1)
+    return lut
+
+BESSEL_LUT = bessel_lut()
+
+def bessel_lookup(x):
+    """
+    Returns the Bessel functions of orders 0, 1 and 2, linearly interpolated
+    from the lookup table. Values beyond the table are 0.
+
+    Args:
+        x: numpy float64 array
+            the points to evaluate the functions at, greater or equal to 0
+    Returns:
+        values: numpy float64 array
+            the value of each order at each point, of shape x.shape + (3,)
+    """
+    alpha = np.asarray(x, np.float64) * BESSEL_RES
+    index = np.floor(alpha).astype(np.int64)
+    inside = index < BESSEL_LEN
+    index = np.minimum(index, BESSEL_LEN - 1)
+    #The last sample is interpolated towards 0
+    following = np.concatenate([BESSEL_LUT[1:], np.zeros((1, 3))])
+    fraction = (alpha - index)[..., np.newaxis]
+    values = BESSEL_LUT[index] + fraction * (following[index] - BESSEL_LUT[index])
+    values[~inside] = 0.0
+    return values
+
+def psf(type, shape, uvdim, magnification, sinalpha, beta=1.0, gamma=1.0, intsteps=50):
+    """
+    Returns the point spread function for unpolarized light in z, r space,
+    according to the diffraction integrals of Richards and Wolf.
+    See supporting information of B Huang et al. Chem Phys Chem (5) 1523-31, 2004.
+    This is psf_batch for a single extent.
+
+    Args:
+        type: integer
+            0 for the excitation psf, 1 for the emission psf
+        shape: (z, r) integer tuple
+            the shape of the output
+        uvdim: (u, v) float tuple
+            the extent of the output in optical units
+        magnification: float
+            the lateral magnification factor
+        sinalpha: float
+            the numerical aperture divided by the refractive index
+        beta: float
+            the underfilling ratio
+        gamma: float
+            the excitation wavelength over the emission wavelength
+        intsteps: integer
+            the number of steps used to integrate over theta
+    Returns:
+        data: numpy 2D float64 array
+            the point spread function, normalized to 1 at the origin
+    """
+    return psf_batch(type, shape, [uvdim], magnification, sinalpha, beta, gamma, intsteps)[0]
+
+def psf_batch(type, shape, uvdims, magnification, sinalpha, beta=1.0, gamma=1.0, intsteps=50):
+    """
+    Returns point spread functions for several extents in optical units at once,
+    such as the same physical extent seen at several wavelengths.
+    The integration steps do not depend on the extent, so the integrals of all
+    functions are computed as a single batch of matrix products.
+
+    Args:
+        type: integer
+            0 for excitation psfs, 1 for emission psfs
+        shape: (z, r) integer tuple
+            the shape of each psf
+        uvdims: sequence of (u, v) float tuples
+            the extent of each psf in optical units
+        magnification, sinalpha, beta, gamma, intsteps:
+            see psf
+    Returns:
+        data: numpy 3D float64 array
+            the point spread functions, each normalized to 1 at the origin
+    """
+    if type not in (0, 1):
+        raise ValueError("type is not 0 or 1")
+    if sinalpha <= 0.0 or sinalpha >= 1.0:
+        raise ValueError("sinalpha is not in interval ]0, 1[")
+    if magnification <= 0.0:
+        raise ValueError("magnification is smaller than 0")
+    if intsteps < 4:
+        raise ValueError("psf() function failed")
+    M = magnification
+    if type == 0:
+        alpha = math.asin(sinalpha)
+        beta = -beta * beta / (sinalpha * sinalpha)
+        gamma = M = 1.0
+    else:
+        alpha = math.asin(sinalpha / M)
+    theta = np.arange(intsteps) * (alpha / (intsteps - 1))
+    st, ct = np.sin(theta), np.cos(theta)
+    if type == 0:
+        apodization = np.sqrt(ct) * np.exp(st * st * beta)
+    else:
+        apodization = np.sqrt(ct / np.sqrt(1.0 - (M * st) ** 2))
+    t = st * apodization
+    #Trapezoid rule weights
+    weights = np.ones(intsteps)
+    weights[[0, -1]] = 0.5
+    factors = np.array([t * (1.0 + ct), t * st * 2.0, t * (1.0 - ct)]) * weights
+    (u_shape, v_shape) = shape
+    uvdims = np.asarray(uvdims, np.float64)
+    u = np.arange(u_shape) * (uvdims[:, 0:1] / (u_shape - 1))
+    v = np.arange(v_shape) * (uvdims[:, 1:2] / (v_shape - 1))
+    #Phase at each (u, theta) and Bessel terms at each (theta, v, order), per psf
+    phase = np.exp(1j * u[:, :, np.newaxis] * (ct * gamma / (sinalpha * sinalpha)))
+    bessel = bessel_lookup((st * gamma / sinalpha)[:, np.newaxis] * v[:, np.newaxis, :])
+    bessel *= factors.T[:, np.newaxis, :]
+    data = np.zeros((len(uvdims),) + tuple(shape))
+    for order in range(3):
+        amplitude = np.matmul(phase, bessel[..., order])
+        data += amplitude.real ** 2 + amplitude.imag ** 2
+    return data / data[:, :1, :1]
+
+def radius_table(dimx, dimy, dimr):
+    """
+    Returns the integer part and fraction of the radius of each (x, y) pixel,
+    as used to interpolate values given in r space.
+
+    Args:
+        dimx, dimy: integer
+            the shape of the table
+        dimr: integer
+            the number of values in r space
+    Returns:
+        ri: numpy 2D int64 array
+            the integer part of the radius, -1 beyond the last value
+        rf: numpy 2D float64 array
+            the fraction of the radius, 0 when there is no next value
+    """
+    r = np.sqrt(np.arange(dimx)[:, np.newaxis] ** 2 + np.arange(dimy)[np.newaxis, :] ** 2.0)
+    ri = np.floor(r).astype(np.int64)
+    rf = np.where(ri + 1 < dimr, r - ri, 0.0)
+    ri[ri >= dimr] = -1
+    return ri, rf
+
+def interpolate(data, ri, rf):
+    """
+    Linearly interpolates data in r space at the radii of radius_table.
+
+    Args:
+        data: numpy float64 array
+            values in r space along the last axis
+        ri, rf: numpy 2D arrays
+            the output of radius_table
+    Returns:
+        out: numpy float64 array
+            the interpolated values, of shape data.shape[:-1] + ri.shape
+    """
+    index = np.maximum(ri, 0)
+    following = np.minimum(index + 1, data.shape[-1] - 1)
+    out = data[..., index] + rf * (data[..., following] - data[..., index])
+    out[..., ri < 0] = 0.0
+    return out
+
+def obsvol(ex_psf, em_psf, detector=None):
+    """
+    Returns the observation volume for one photon excitation in z, r space,
+    the product of the excitation psf with the emission psf integrated over
+    the detector kernel.
+
+    Args:
+        ex_psf: numpy 2D float64 array
+            the excitation psf in z, r space
+        em_psf: numpy 2D float64 array
+            the emission psf in z, r space, same shape as ex_psf
+        detector: numpy 2D float64 array or None
+            the detector kernel in x, y space, see pinhole_kernel.
+            If None, a large pinhole (widefield) approximation is used
+    Returns:
+        data: numpy 2D float64 array
+            the observation volume, normalized to 1 at the origin
+    """
+    ex_psf = np.asarray(ex_psf, np.float64)
+    em_psf = np.asarray(em_psf, np.float64)
+    if ex_psf.ndim == 3 or em_psf.ndim == 3:
+        raise NotImplementedError("three dimensional PSF are not supported")
+    if ex_psf.ndim != 2 or em_psf.ndim != 2:
+        raise ValueError("not all PSF arrays are 2 dimensional")
+    if ex_psf.shape != em_psf.shape:
+        raise ValueError("PSF arrays are not same size")
+    if detector is not None:
+        detector = np.asarray(detector, np.float64)
+        if detector.ndim != 2 or detector.shape[0] != detector.shape[1]:
+            raise ValueError("detector kernel is not square")
+    (dimz, dimr) = ex_psf.shape
+    if detector is None:
+        #Emission integrated over the whole plane
+        r = np.arange(dimr, dtype=np.float64)
+        r[0] = math.pi * 0.25
+        data = ex_psf * (2 * math.pi * np.dot(em_psf, r))[:, np.newaxis]
+    elif detector.shape[0] < 2:
+        data = ex_psf * em_psf
+    else:
+        kernel_dim = detector.shape[0]
+        dimd = min(kernel_dim, dimr)
+        #Emission psf in x, y space, only the dimd first columns are needed
+        em_xy = interpolate(em_psf, *radius_table(dimr, dimd, dimr))
+        #Products of each row of the emission psf with each row of the kernel
+        rows = np.einsum('zxy,iy->zxi', em_xy, detector[:, :dimd])
+        #The kernel row |x - r + offset| is applied to the emission row |x|
+        r = np.arange(dimr)[:, np.newaxis]
+        k = np.arange(2 * dimd - 1)[np.newaxis, :]
+        x = r - dimd + 1 + k
+        i = np.abs(k + 1 - dimd + kernel_dim - dimd)
+        inside = x < dimr
+        x = np.abs(np.where(inside, x, 0))
+        data = ex_psf * (rows[:, x, i] * inside).sum(axis=2)
+    return data / data[0, 0]
+
+def pinhole_kernel(radius, corners=0):
+    """
+    Returns the kernel integrating over the pinhole with the trapezoid rule,
+    for the quadrant x >= 0, y >= 0. Columns other than the first are doubled,
+    to account for the symmetric half along y.
+
+    Args:
+        radius: float
+            the outer radius of the pinhole in pixels, for square pinholes
+            the radius of the circumscribed circle
+        corners: integer
+            0 for a round pinhole, 4 for a square one
+    Returns:
+        kernel: numpy 2D float64 array
+            the pinhole kernel
+    """
+    if corners not in (0, 4):
+        raise ValueError("pinhole shape not supported: %i" % corners)
+    radius = float(radius)
+    if corners == 4:
+        radius /= math.sqrt(2.0)
+    dim = int(math.ceil(radius)) + 1
+    out = np.ones((dim, dim))
+    if corners == 0:
+        t = (math.sqrt(2.0 * dim * dim) - dim) / math.sqrt(2.0)
+        k = dim - int(math.ceil(t))
+        out[k:, k:] = 0.0
+        #Antialiased arc, using eightfold symmetry
+        for j in range(int(math.floor((dim - 1) / math.sqrt(2))) + 1):
+            k = int(math.ceil(math.sqrt(radius * radius - j * j)))
+            out[k, j] = out[j, k] = 0.5 * (1.0 - (math.sqrt(k * k + j * j) - radius))
+            if k > 0:
+                k -= 1
+                out[k, j] = out[j, k] = 0.5 + 0.5 * (radius - math.sqrt(k * k + j * j))
+            out[k + 2:, j] = out[j, k + 2:] = 0.0
+    else:
+        alpha = 0.5 * (radius - math.floor(radius))
+        out[:, dim - 1] *= alpha
+        out[dim - 1, :] *= alpha
+        alpha += 0.5
+        if dim > 1:
+            out[:dim - 1, dim - 2] *= alpha
+            out[dim - 2, :dim - 1] *= alpha
+    out[:, 1:] *= 2.0
+    return out
+
+def zr2zxy(data):
+    """
+    Returns a new array with rotational symmetry applied around the first dimension,
+    values being linearly interpolated along the radius.
+
+    Args:
+        data: numpy 1D or 2D float64 array
+            values in r space, or in z, r space
+    Returns:
+        out: numpy 2D or 3D float64 array
+            values in x, y space, or in z, x, y space, for x, y >= 0
+    """
+    data = np.asarray(data, np.float64)
+    if data.ndim not in (1, 2):
+        raise ValueError("input array is not 1 or 2 dimensional")
+    dimr = data.shape[-1]
+    return interpolate(data, *radius_table(dimr, dimr, dimr))
+
+def gaussian2d(shape, sigma):
+    """
+    Returns a 2D gaussian in z, r space.
+
+    Args:
+        shape: (z, r) integer tuple
+            the shape of the output
+        sigma: (z, r) float tuple
+            the standard deviation along each axis, in pixels
+    Returns:
+        data: numpy 2D float64 array
+            the gaussian, 1 at the origin
+    """
+    if len(shape) != 2 or len(sigma) != 2:
+        raise ValueError("input parameters must be sequences of length 2")
+    if sigma[0] == 0 or sigma[1] == 0:
+        raise ValueError("gaussian2d() function failed")
+    z = np.arange(int(shape[0]))[:, np.newaxis] ** 2 * (-0.5 / (sigma[0] * sigma[0]))
+    r = np.arange(int(shape[1]))[np.newaxis, :] ** 2 * (-0.5 / (sigma[1] * sigma[1]))
+    return np.exp(z + r)
+
+def sigma_widefield(nk, cosa):
+    """
+    Returns the gaussian parameters for the nonparaxial widefield case.
+
+    Args:
+        nk: float
+            the wavenumber in the medium
+        cosa: float
+            the cosine of the aperture half angle
+    Returns:
+        sz, sr: float
+            the standard deviation along z and r
+    """
+    t = cosa ** 1.5
+    sr = 1.0 / (nk * math.sqrt((4. - 7. * t + 3. * cosa ** 3.5) / (7. * (1. - t))))
+    sz = (5. * math.sqrt(7.) * (1. - t)) / (nk * math.sqrt(6. * (4. * cosa ** 5 -\
+         25. * cosa ** 3.5 + 42. * cosa ** 2.5 - 25. * t + 4.)))
+    return sz, sr
+
+def gaussian_sigma(lex, lem, num_aperture, refr_index, pinhole_radius=1.0,\
+                   widefield=True, paraxial=False):
+    """
+    Returns the gaussian parameters approximating the point spread function,
+    according to B Zhang et al. Appl. Optics (46) 1819-29, 2007.
+
+    Args:
+        lex, lem: float
+            the excitation and emission wavelengths
+        num_aperture: float
+            the numerical aperture
+        refr_index: float
+            the refractive index of the medium
+        pinhole_radius: float
+            the pinhole radius, in the units of the wavelengths
+        widefield: boolean
+            whether to approximate a widefield microscope
+        paraxial: boolean
+            whether to use the paraxial approximation
+    Returns:
+        sz, sr: float
+            the standard deviation along z and r
+    """
+    NA, n, r = float(num_aperture), float(refr_index), float(pinhole_radius)
+    if NA <= 0.0 or n <= 0.0 or lem <= 0.0 or NA / n >= 1.0:
+        raise ValueError("gaussian_sigma() function failed")
+    if widefield:
+        if paraxial:
+            sr = math.sqrt(2.) * lem / (2 * math.pi * NA)
+            sz = math.sqrt(6.) * lem / (2 * math.pi * NA * NA) * n * 2.
+        else:
+            sz, sr = sigma_widefield(n * 2 * math.pi / lem, math.cos(math.asin(NA / n)))
+        return sz, sr
+    if r <= 0.0 or lex <= 0.0:
+        raise ValueError("gaussian_sigma() function failed")
+    if paraxial:
+        kem = 2 * math.pi / lem
+        c1 = 2 * math.pi / lex * r * NA
+        c2 = 2 * math.pi / lem * r * NA
+        J0, J1, _ = bessel_lookup(c2)
+        #Invalid parameters give nan like psf.c, rather than raising
+        sr = np.sqrt(2. / (c1 * c1 / (r * r) +\
+             (4. * c2 * J0 * J1 - 8. * J1 * J1) / (r * r * (J0 * J0 + J1 * J1 - 1.))))
+        sz = 2. * np.sqrt(6. / ((c1 * c1 * NA * NA) / (r * r * n * n) -\
+             (48. * c2 * c2 * (J0 * J0 + J1 * J1) - 192. * J1 * J1) /\
+             (n * n * kem * kem * r * r * r * r * (J0 * J0 + J1 * J1 - 1.))))
+    else:
+        cosa = math.cos(math.asin(NA / n))
+        sz_ex, sr_ex = sigma_widefield(n * 2 * math.pi / lex, cosa)
+        sz_em, sr_em = sigma_widefield(n * 2 * math.pi / lem, cosa)
+        e = sr_em * sr_em
+        e = 2.0 * e * e * (math.exp(r * r / (2.0 * e)) - 1.0)
+        sr = math.sqrt((sr_ex * sr_ex * e) / (e + r * r * sr_ex * sr_ex))
+        sz = sz_ex * sz_em / math.sqrt(sz_ex * sz_ex + sz_em * sz_em)
+    return float(sz), float(sr)
@@ -0,0 +1,961 @@
+# Provided under BSD license
+# Copyright (c) 2017, Jeremy Wohlwend
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#  - Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  - Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#  - Neither the name of SimExm nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without specific
+#    prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JEREMY WOHLWEND BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+convolution.py
+
+Convolution backends used to blur photon volumes with a point spread function.
+All methods treat the volume borders by reflection, and return a volume
+of the same shape as the input.
+    - direct: convolution in the spatial domain, for small kernels
+    - fft: reflect padding followed by a 'valid' FFT convolution
+    - overlap-add: FFT convolution of the padded volume block by block,
+      for kernels much smaller than the volume. Empty blocks are skipped
+    - separable: three 1D convolutions, for kernels equal to the outer
+      product of their profiles, such as gaussians
+    - splat: adds a copy of the point spread function at each nonzero voxel,
+      much faster for sparse volumes
+A cost model picks the cheapest method when none is given. Its constants
+are calibrated once per machine by a short benchmark and cached on disk,
+in COSTS_FILE.
+
+Convolutions may run in single or double precision. FFTs are computed with
+one of the following backends:
+    - numpy: numpy.fft, single threaded and always in double precision
+    - scipy: scipy.fft with multiple workers, falls back to numpy.fft on
+      older scipy versions
+    - pyfftw: multi-threaded FFTW, plans are cached and reused for
+      arrays of the same shape
+The FFT of each point spread function is cached per transform shape,
+so it is computed once across fluorophores, channels and calls to resolve.
+
+When only every z_step-th plane binned by xy_step is needed, as in optics.scale,
+the FFT method computes the convolution on those planes only.
+
+Padded volumes are written to work arrays reused across calls, see work_array,
+with their reflected borders filled in place.
+"""
+
+import os
+import json
+import time
+import itertools
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from scipy.fftpack import next_fast_len
+from scipy import ndimage
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+
+#Names of the convolution methods
+METHODS = ('direct', 'fft', 'overlap-add', 'separable', 'splat')
+
+#Rough cost of each method in seconds per unit of work, on a single core,
+#used until the machine is calibrated. See method_work for the units.
+DEFAULT_COSTS = {'direct': 2e-9, 'fft': 1.2e-8, 'overlap-add': 1.2e-8,\
+                 'separable': 4e-9, 'splat': 1.5e-8}
+#Fixed overhead of splatting a voxel, in psf voxels added
+SPLAT_OVERHEAD = 700
+#Cost of adding a psf tap to scattered voxels relative to adding it to a contiguous block,
+#small psfs are splatted one tap at a time over all voxels instead of one voxel at a time
+SPLAT_GATHER = 3
+#Calibrated costs, loaded or measured on the first call to method_costs
+COSTS = {}
+COSTS_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'simexm', 'convolution_costs.json')
+
+#Precision names used in the configuration
+DTYPE = {'single': np.float32, 'double': np.float64}
+
+def convolve(volume, psf_vol, method='auto', z_step=1, xy_step=1, precision='double',\
+             fft_backend='scipy', fft_workers=1, **kwargs):
+    """
+    Convolves the volume with the given point spread function.
+    The output may be sampled with steps greater than 1, see bin_planes.
+
+    Args:
+        volume: numpy 3D array
+            the volume to convolve
+        psf_vol: numpy 3D float64 array
+            the point spread function, with odd dimensions
+        method: string
+            one of METHODS or 'auto'. If 'auto', the method is
+            picked using the cost model in choose_method
+        z_step: integer
+            only one every z_step planes of the output is computed
+        xy_step: integer
+            output pixels are binned by xy_step in the x and y axis
+        precision: string
+            'single' or 'double', the floating point precision to use
+        fft_backend: string
+            one of 'numpy', 'scipy' or 'pyfftw', the library used for FFTs
+        fft_workers: integer
+            number of threads used by the FFT backend, 0 uses all cores
+    Returns:
+        out: numpy 3D float array
+            the convolved volume, same shape as the input when not sampled
+    """
+    method = choose_method(volume, psf_vol, method)
+    dtype = DTYPE[precision]
+    sampled = z_step > 1 or xy_step > 1
+    if method == 'fft' and sampled:
+        return sampled_fft_convolve(volume, psf_vol, z_step, xy_step, dtype, fft_backend, fft_workers)
+    if method == 'fft':
+        return fft_convolve(volume, psf_vol, dtype, fft_backend, fft_workers)
+    if method == 'overlap-add':
+        out = overlap_add_convolve(volume, psf_vol, dtype, fft_backend, fft_workers)
+    elif method == 'direct':
+        out = direct_convolve(volume, psf_vol, dtype)
+    elif method == 'separable':
+        out = separable_convolve(volume, psf_vol, dtype)
+    else:
+        out = splat_convolve(volume, psf_vol, dtype)
+    return bin_planes(out, z_step, xy_step) if sampled else out
+
+#Kernels already downsampled, keyed by psf identity and step
+DOWNSAMPLED_PSF = {}
+
+def downsample_psf(psf_vol, xy_step):
+    """
+    Resamples the point spread function to a grid coarser by xy_step in x and y,
+    to convolve volumes binned with bin_planes. Each coarse value is the photon count
+    received by a bin from a source in another bin, integrated over the receiving bin
+    and averaged over the position of the source within its bin.
+
+    Args:
+        psf_vol: numpy 3D float64 array
+            the point spread function, with odd dimensions
+        xy_step: integer
+            the size of the bins in the x and y axis
+    Returns:
+        kernel: numpy 3D float64 array
+            the point spread function on the coarse grid, with odd dimensions
+    """
+    key = (id(psf_vol), xy_step)
+    if key in DOWNSAMPLED_PSF and DOWNSAMPLED_PSF[key][0] is psf_vol:
+        return DOWNSAMPLED_PSF[key][1]
+    (d, w, h) = psf_vol.shape
+    #Matrices mapping fine offsets to coarse ones, averaged over the source position
+    x_bins = np.mean(bin_matrices(w, xy_step), axis=0)
+    y_bins = np.mean(bin_matrices(h, xy_step), axis=0)
+    kernel = np.einsum('ax,zxy,by->zab', x_bins, psf_vol, y_bins)
+    DOWNSAMPLED_PSF[key] = (psf_vol, kernel)
+    return kernel
+
+#Size of the sample used to check downsampled convolutions, in bins
+ACCURACY_SAMPLE = 16
+
+def downsampling_error(volume, psf_vol, xy_step, **kwargs):
+    """
+    Checks the accuracy of a downsampled convolution against the full resolution one.
+    Both are computed on a sample around the center of the labeled part of the volume,
+    and compared away from the sample borders, where they reflect differently.
+
+    Args:
+        volume: numpy 3D array
+            the volume to convolve
+        psf_vol: numpy 3D float64 array
+            the point spread function, with odd dimensions
+        xy_step: integer
+            the size of the bins in the x and y axis
+        kwargs: dict
+            precision and FFT parameters, see convolve
+    Returns:
+        error: float
+            the relative L1 error of the downsampled convolution,
+            infinite if the volume is too small to be checked
+    """
+    kernel = downsample_psf(psf_vol, xy_step)
+    window = nonzero_window(volume, psf_vol.shape, 1, xy_step)
+    if window is None:
+        return 0.0
+    #Margin of bins ignored on each side of the sample
+    margin = kernel.shape[1] // 2 + 1
+    sample = []
+    for axis, (w, size) in enumerate(zip(window, (psf_vol.shape[0], ACCURACY_SAMPLE, ACCURACY_SAMPLE))):
+        step = 1 if axis == 0 else xy_step
+        length = (size + 2 * margin) * step if axis > 0 else size
+        center = (w.start + w.stop) // 2
+        start = max(min(center - length // 2, w.stop - length), w.start)
+        start -= start % step
+        sample.append(slice(start, min(start + length, volume.shape[axis])))
+    volume = volume[tuple(sample)]
+    if min(volume.shape[1:]) <= 2 * margin * xy_step:
+        return np.inf
+    full = bin_planes(convolve(volume, psf_vol, **kwargs), 1, xy_step)
+    coarse = convolve(bin_planes(volume, 1, xy_step), kernel, **kwargs)
+    full, coarse = full[:, margin:-margin, margin:-margin], coarse[:, margin:-margin, margin:-margin]
+    total = np.abs(full).sum()
+    return np.abs(coarse - full).sum() / total if total > 0 else 0.0
+
+def bin_matrices(size, step):
+    """
+    Computes, for each position of a source within a bin, the matrix summing
+    the fine offsets of a centered kernel into coarse offsets between bins.
+
+    Args:
+        size: integer
+            the size of the kernel along the axis, odd
+        step: integer
+            the size of the bins
+    Returns:
+        matrices: list of numpy 2D float64 arrays
+            a (coarse size x size) matrix for each source position in the bin
+    """
+    c = size // 2
+    n = (c + step - 1) // step
+    offsets = np.arange(-c, c + 1)[np.newaxis, :] - step * np.arange(-n, n + 1)[:, np.newaxis]
+    return [np.logical_and(offsets + b >= 0, offsets + b < step).astype(np.float64)\
+            for b in range(step)]
+
+def nonzero_window(volume, psf_shape, z_step=1, xy_step=1):
+    """
+    Computes the smallest window of the volume holding all of its nonzero voxels
+    and the halo of the point spread function around them. Convolving the window
+    alone gives the exact convolution of the volume, which is 0 outside of it.
+    The window starts on a multiple of the sampling steps, so that a sampled
+    convolution of the window lines up with the sampling of the whole volume.
+
+    Args:
+        volume: numpy 3D array
+            the volume to convolve
+        psf_shape: (z, x, y) integer tuple
+            the shape of the point spread function
+        z_step: integer
+            the sampling step along z, see bin_planes
+        xy_step: integer
+            the sampling step in x and y, see bin_planes
+    Returns:
+        window: tuple of 3 slices or None
+            the window in the volume, None if the volume is empty
+    """
+    window = []
+    for axis, (size, k, step) in enumerate(zip(volume.shape, psf_shape, (z_step, xy_step, xy_step))):
+        other_axes = tuple(a for a in range(3) if a != axis)
+        indices = np.flatnonzero(np.any(volume, axis=other_axes))
+        if len(indices) == 0:
+            return None
+        #One more voxel of margin, so that the reflected borders of the window stay empty
+        start = max(indices[0] - k // 2 - 1, 0)
+        start -= start % step
+        stop = min(indices[-1] + k // 2 + 2, size)
+        window.append(slice(start, stop))
+    return tuple(window)
+
+def choose_method(volume, psf_vol, method='auto'):
+    """
+    Estimates the cost of each convolution method and returns the cheapest.
+    A method given explicitly is kept if it can be used for this volume and
+    point spread function, otherwise the cheapest one is picked instead.
+
+    Args:
+        volume: numpy 3D array
+            the volume to convolve
+        psf_vol: numpy 3D array
+            the point spread function
+        method: string
+            one of METHODS or 'auto'
+    Returns:
+        method: string
+            the name of the method to use, one of METHODS
+    """
+    methods = usable_methods(volume, psf_vol)
+    if method in methods:
+        return method
+    if method != 'auto':
+        print "Warning: the {} convolution method can't be used for this point "\
+              "spread function, using the cheapest method instead.".format(method)
+    costs = method_costs()
+    return min(methods, key=lambda m: costs[m] * method_work(m, volume, psf_vol))
+
+def usable_methods(volume, psf_vol):
+    """
+    Lists the convolution methods giving the exact reflected convolution
+    of the volume with the point spread function.
+
+    Args:
+        volume: numpy 3D array
+            the volume to convolve
+        psf_vol: numpy 3D array
+            the point spread function
+    Returns:
+        methods: list of strings
+            the usable methods, among METHODS
+    """
+    methods = ['direct', 'fft', 'overlap-add']
+    #Splatting relies on a single reflection of the borders, and so
+    #does the separable method in scipy.ndimage
+    if np.all(np.array(volume.shape) > np.array(psf_vol.shape) // 2):
+        methods.append('splat')
+        if separable_factors(psf_vol) is not None:
+            methods.append('separable')
+    return methods
+
+def method_work(method, volume, psf_vol):
+    """
+    Returns the amount of work done by a convolution method, in the units of
+    the cost model: voxel * psf voxel products for the direct method,
+    voxel * log2(voxels) of each transform for FFT methods, voxel * psf length
+    for the separable method and psf voxels added for splatting, including
+    the overhead of the python loop, see splat_convolve.
+
+    Args:
+        method: string
+            one of METHODS
+        volume: numpy 3D array
+            the volume to convolve
+        psf_vol: numpy 3D array
+            the point spread function
+    Returns:
+        work: float
+            the amount of work
+    """
+    if method == 'direct':
+        return float(volume.size) * psf_vol.size
+    if method == 'separable':
+        return float(volume.size) * sum(psf_vol.shape)
+    if method == 'splat':
+        return float(np.count_nonzero(volume)) * splat_voxel_work(psf_vol.size)
+    padded = np.array(volume.shape) + np.array(psf_vol.shape) - 1
+    if method == 'fft':
+        shape = [next_fast_len(p + k - 1) for p, k in zip(padded, psf_vol.shape)]
+        blocks = 1
+    else:
+        sizes, shape = overlap_add_blocks(padded, psf_vol.shape)
+        blocks = np.prod([-(-p // b) for p, b in zip(padded, sizes)], dtype=np.float64)
+    size = np.prod(shape, dtype=np.float64)
+    return blocks * size * np.log2(size)
+
+def method_costs():
+    """
+    Returns the cost of each convolution method per unit of work, see method_work.
+    Costs are read from COSTS_FILE, or measured by calibrate_costs and saved
+    to it if the file does not exist.
+
+    Returns:
+        costs: dict
+            the cost of each method, in seconds per unit of work
+    """
+    if COSTS:
+        return COSTS
+    COSTS.update(DEFAULT_COSTS)
+    try:
+        with open(COSTS_FILE) as f:
+            COSTS.update(json.load(f))
+        return COSTS
+    except (IOError, ValueError):
+        pass
+    print "Calibrating convolution methods, results are saved to {}".format(COSTS_FILE)
+    COSTS.update(calibrate_costs())
+    try:
+        if not os.path.isdir(os.path.dirname(COSTS_FILE)):
+            os.makedirs(os.path.dirname(COSTS_FILE))
+        with open(COSTS_FILE, 'w') as f:
+            json.dump(COSTS, f, indent=4, sort_keys=True)
+    except (IOError, OSError):
+        print "Warning: could not save the convolution costs to {}".format(COSTS_FILE)
+    return COSTS
+
+#Shapes of the calibration benchmark, small enough to run in about a second
+CALIBRATION_VOLUME = (32, 48, 48)
+CALIBRATION_PSF = (9, 9, 9)
+
+def calibrate_costs(repeat=3):
+    """
+    Times each convolution method on a small volume and derives its cost
+    per unit of work. The best of several runs is kept.
+
+    Args:
+        repeat: integer
+            the number of times each method is run
+    Returns:
+        costs: dict
+            the cost of each method, in seconds per unit of work
+    """
+    state = np.random.get_state()
+    np.random.seed(0)
+    #A gaussian kernel, so that every method can be used
+    profiles = [np.exp(-np.linspace(-2, 2, k) ** 2) for k in CALIBRATION_PSF]
+    psf_vol = np.einsum('z,x,y->zxy', *profiles)
+    volume = np.random.poisson(0.01, CALIBRATION_VOLUME).astype(np.float64)
+    np.random.set_state(state)
+    costs = {}
+    for method in METHODS:
+        if method == 'fft':
+            run = lambda: fft_convolve(volume, psf_vol)
+        elif method == 'overlap-add':
+            run = lambda: overlap_add_convolve(volume, psf_vol)
+        elif method == 'direct':
+            run = lambda: direct_convolve(volume, psf_vol)
+        elif method == 'separable':
+            run = lambda: separable_convolve(volume, psf_vol)
+        else:
+            run = lambda: splat_convolve(volume, psf_vol)
+        timings = []
+        for _ in range(repeat):
+            start = time.time()
+            run()
+            timings.append(time.time() - start)
+        costs[method] = max(min(timings), 1e-6) / method_work(method, volume, psf_vol)
+    return costs
+
+def fft_convolve(volume, psf_vol, dtype=np.float64, fft_backend='scipy', fft_workers=1):
+    """
+    Convolves the volume with the point spread function using FFTs.
+    The volume is padded by reflection so that the output has the same shape.
+
+    Args:
+        volume: numpy 3D array
+            the volume to convolve
+        psf_vol: numpy 3D float64 array
+            the point spread function, with odd dimensions
+        dtype: numpy float type
+            the precision to use, np.float32 or np.float64
+        fft_backend: string
+            one of 'numpy', 'scipy' or 'pyfftw'
+        fft_workers: integer
+            number of threads used by the FFT backend, 0 uses all cores
+    Returns:
+        out: numpy 3D float array
+            the convolved volume, same shape as the input
+    """
+    (d, w, h) = psf_vol.shape
+    padded = reflect_pad(volume, (d / 2, w / 2, h / 2), dtype)
+    #Linear convolution size, rounded up to sizes the FFT handles well
+    shape = tuple(next_fast_len(p + k - 1) for p, k in zip(padded.shape, psf_vol.shape))
+    rfftn, irfftn = fft_functions(fft_backend, fft_workers)
+    spectrum = rfftn(padded, shape)
+    spectrum *= psf_spectrum(psf_vol, shape, dtype, rfftn)
+    full = irfftn(spectrum, shape)
+    #Keep the 'valid' part of the convolution
+    (z, x, y) = volume.shape
+    return full[d - 1:d - 1 + z, w - 1:w - 1 + x, h - 1:h - 1 + y].astype(dtype, copy=False)
+
+def direct_convolve(volume, psf_vol, dtype=np.float64):
+    """
+    Convolves the volume with the point spread function in the spatial domain.
+    Borders are mirrored, which matches the output of fft_convolve.
+
+    Args:
+        volume: numpy 3D array
+            the volume to convolve
+        psf_vol: numpy 3D float64 array
+            the point spread function, with odd dimensions
+        dtype: numpy float type
+            the precision to use, np.float32 or np.float64
+    Returns:
+        out: numpy 3D float array
+            the convolved volume, same shape as the input
+    """
+    return ndimage.convolve(volume.astype(dtype, copy=False), psf_vol.astype(dtype, copy=False),\
+                            mode='mirror')
+
+#Profiles of separable psfs, keyed by psf identity
+SEPARABLE_PSF = {}
+#Largest error of the product of the profiles, relative to the psf maximum
+SEPARABLE_TOLERANCE = 1e-6
+
+def separable_factors(psf_vol):
+    """
+    Finds the z, x and y profiles whose outer product is the point spread function.
+
+    Args:
+        psf_vol: numpy 3D float64 array
+            the point spread function
+    Returns:
+        profiles: tuple of three numpy 1D float64 arrays or None
+            the profiles along each axis, None if the psf is not separable
+    """
+    key = id(psf_vol)
+    if key in SEPARABLE_PSF and SEPARABLE_PSF[key][0] is psf_vol:
+        return SEPARABLE_PSF[key][1]
+    total = psf_vol.sum()
+    profiles = None
+    if total > 0:
+        profiles = (psf_vol.sum(axis=(1, 2)) / total, psf_vol.sum(axis=(0, 2)) / total,\
+                    psf_vol.sum(axis=(0, 1)))
+        error = np.abs(np.einsum('z,x,y->zxy', *profiles) - psf_vol).max()
+        if error > SEPARABLE_TOLERANCE * psf_vol.max():
+            profiles = None
+    SEPARABLE_PSF[key] = (psf_vol, profiles)
+    return profiles
+
+def separable_convolve(volume, psf_vol, dtype=np.float64):
+    """
+    Convolves the volume with a separable point spread function,
+    as three 1D convolutions along each axis. Borders are mirrored,
+    which matches the output of fft_convolve.
+
+    Args:
+        volume: numpy 3D array
+            the volume to convolve
+        psf_vol: numpy 3D float64 array
+            the point spread function, with odd dimensions, see separable_factors
+        dtype: numpy float type
+            the precision to use, np.float32 or np.float64
+    Returns:
+        out: numpy 3D float array
+            the convolved volume, same shape as the input
+    """
+    out = volume.astype(dtype, copy=False)
+    for axis, profile in enumerate(separable_factors(psf_vol)):
+        out = ndimage.convolve1d(out, profile.astype(dtype), axis, mode='mirror')
+    return out
+
+#Size of the overlap-add transforms, in kernel lengths
+OVERLAP_FACTOR = 4
+
+def overlap_add_blocks(padded_shape, psf_shape):
+    """
+    Returns the size of the blocks used by overlap_add_convolve and the
+    shape of their transforms.
+
+    Args:
+        padded_shape: integer tuple
+            the shape of the padded volume
+        psf_shape: integer tuple
+            the shape of the point spread function
+    Returns:
+        blocks: integer tuple
+            the size of the blocks along each axis
+        shape: integer tuple
+            the shape of the transforms
+    """
+    blocks, shape = [], []
+    for p, k in zip(padded_shape, psf_shape):
+        n = next_fast_len(OVERLAP_FACTOR * k)
+        #A single block if the volume is not much larger than the kernel
+        if n - k + 1 >= p:
+            n = next_fast_len(p + k - 1)
+        blocks.append(min(n - k + 1, p))
+        shape.append(n)
+    return tuple(blocks), tuple(shape)
+
+def overlap_add_convolve(volume, psf_vol, dtype=np.float64, fft_backend='scipy', fft_workers=1):
+    """
+    Convolves the volume with the point spread function using FFTs of
+    blocks of the padded volume, adding the convolved blocks together.
+    Transforms are smaller than with fft_convolve, and empty blocks are skipped.
+
+    Args:
+        volume: numpy 3D array
+            the volume to convolve
+        psf_vol: numpy 3D float64 array
+            the point spread function, with odd dimensions
+        dtype: numpy float type
+            the precision to use, np.float32 or np.float64
+        fft_backend: string
+            one of 'numpy', 'scipy' or 'pyfftw'
+        fft_workers: integer
+            number of threads used by the FFT backend, 0 uses all cores
+    Returns:
+        out: numpy 3D float array
+            the convolved volume, same shape as the input
+    """
+    (d, w, h) = psf_vol.shape
+    padded = reflect_pad(volume, (d / 2, w / 2, h / 2), dtype)
+    blocks, shape = overlap_add_blocks(padded.shape, psf_vol.shape)
+    rfftn, irfftn = fft_functions(fft_backend, fft_workers)
+    spectrum = psf_spectrum(psf_vol, shape, dtype, rfftn)
+    out = np.zeros(volume.shape, dtype)
+    starts = [range(0, p, b) for p, b in zip(padded.shape, blocks)]
+    for start in itertools.product(*starts):
+        block = padded[tuple(slice(s, s + b) for s, b in zip(start, blocks))]
+        if not block.any():
+            continue
+        full = irfftn(rfftn(block, shape) * spectrum, shape)
+        #Output voxel i is full voxel i + k - 1 of the padded convolution
+        src, dst = [], []
+        for s, n, k, size in zip(start, block.shape, psf_vol.shape, volume.shape):
+            low, high = max(s - k + 1, 0), min(s + n, size)
+            src.append(slice(low - s + k - 1, high - s + k - 1))
+            dst.append(slice(low, high))
+        out[tuple(dst)] += full[tuple(src)]
+    return out
+
+#Cached psf spectra, keyed by psf identity, transform shape and precision.
+#Spectra are as large as the volume, so the cache is bounded in bytes.
+SPECTRUM_CACHE = OrderedDict()
+SPECTRUM_CACHE_BYTES = 2 ** 30
+
+def psf_spectrum(psf_vol, shape, dtype, rfftn, axes=None):
+    """
+    Returns the FFT of the point spread function zero padded to the given shape,
+    over the given axes.
+    Spectra are cached, the least recently used ones are discarded first
+    when the cache grows over SPECTRUM_CACHE_BYTES.
+
+    Args:
+        psf_vol: numpy 3D float64 array
+            the point spread function
+        shape: integer tuple
+            the shape of the transform
+        dtype: numpy float type
+            the precision to use, np.float32 or np.float64
+        rfftn: function (array, shape, axes) -> array
+            the forward transform to use, see fft_functions
+        axes: integer tuple or None
+            the axes to transform, all of them if None
+    Returns:
+        spectrum: numpy 3D complex array
+            the transform of the point spread function
+    """
+    key = (id(psf_vol), shape, axes, np.dtype(dtype).name)
+    if key in SPECTRUM_CACHE:
+        cached_psf, spectrum = SPECTRUM_CACHE.pop(key)
+        #The psf is kept in the cache so that its id can't be reused
+        if cached_psf is psf_vol:
+            SPECTRUM_CACHE[key] = (cached_psf, spectrum)
+            return spectrum
+    spectrum = rfftn(psf_vol.astype(dtype, copy=False), shape, axes)
+    if spectrum.nbytes <= SPECTRUM_CACHE_BYTES:
+        SPECTRUM_CACHE[key] = (psf_vol, spectrum)
+        while sum(s.nbytes for _, s in SPECTRUM_CACHE.values()) > SPECTRUM_CACHE_BYTES:
+            SPECTRUM_CACHE.popitem(last=False)
+    return spectrum
+
+def sampled_fft_convolve(volume, psf_vol, z_step, xy_step, dtype=np.float64,\
+                         fft_backend='scipy', fft_workers=1):
+    """
+    Convolves the volume with the point spread function using FFTs, computing
+    only one every z_step planes, binned by xy_step in the x and y axis.
+    Planes are transformed in 2D, and the convolution along z is evaluated
+    directly in frequency space at the kept planes only, so that only these
+    planes are transformed back.
+
+    Args:
+        volume: numpy 3D array
+            the volume to convolve
+        psf_vol: numpy 3D float64 array
+            the point spread function, with odd dimensions
+        z_step: integer
+            only one every z_step planes is computed
+        xy_step: integer
+            the size of the bins in the x and y axis
+        dtype: numpy float type
+            the precision to use, np.float32 or np.float64
+        fft_backend: string
+            one of 'numpy', 'scipy' or 'pyfftw'
+        fft_workers: integer
+            number of threads used by the FFT backend, 0 uses all cores
+    Returns:
+        out: numpy 3D float array
+            the sampled convolved volume, see bin_planes for its shape
+    """
+    (d, w, h) = psf_vol.shape
+    padded = reflect_pad(volume, (d / 2, w / 2, h / 2), dtype)
+    shape = tuple(next_fast_len(p + k - 1) for p, k in zip(padded.shape[1:], psf_vol.shape[1:]))
+    rfftn, irfftn = fft_functions(fft_backend, fft_workers)
+    planes = rfftn(padded, shape, (1, 2))
+    kernel = psf_spectrum(psf_vol, shape, dtype, rfftn, (1, 2))
+    (z, x, y) = volume.shape
+    out = []
+    for i in range(0, z, z_step):
+        #Output plane i of the 'valid' convolution sums padded planes i to i + d - 1
+        #with the psf planes in reverse order
+        spectrum = np.einsum('kij,kij->ij', planes[i:i + d][::-1], kernel)
+        plane = irfftn(spectrum, shape, (0, 1))[w - 1:w - 1 + x, h - 1:h - 1 + y]
+        out.append(bin_planes(plane[np.newaxis], 1, xy_step)[0].astype(dtype, copy=False))
+    return np.array(out)
+
+#Work arrays, keyed by name. Each one is a flat buffer grown to the largest
+#size requested so far, and viewed with the requested shape.
+WORK_ARRAYS = {}
+#Number of work arrays requested and actually allocated
+WORK_STATS = {'requests': 0, 'allocations': 0}
+
+def work_array(name, shape, dtype):
+    """
+    Returns an uninitialized array backed by a buffer reused across calls.
+    The array is only valid until the next request with the same name.
+
+    Args:
+        name: string
+            the name of the buffer
+        shape: integer tuple
+            the shape of the array
+        dtype: numpy type
+            the type of the array
+    Returns:
+        array: numpy array
+            a view of the buffer with the given shape and type
+    """
+    size = int(np.prod(shape))
+    WORK_STATS['requests'] += 1
+    buffer = WORK_ARRAYS.get(name)
+    if buffer is None or buffer.dtype != np.dtype(dtype) or buffer.size < size:
+        #Drop the old buffer first, so that both are not held at once
+        WORK_ARRAYS.pop(name, None)
+        del buffer
+        buffer = WORK_ARRAYS[name] = np.empty(size, dtype)
+        WORK_STATS['allocations'] += 1
+    return buffer[:size].reshape(shape)
+
+def release_work_arrays():
+    """
+    Releases the work arrays and the FFTW plans along with their buffers.
+    They are as large as the convolved volumes and only needed while convolving.
+    """
+    WORK_ARRAYS.clear()
+    FFTW_PLANS.clear()
+
+def clear_caches():
+    """
+    Releases the work arrays, the FFTW plans and the cached psf spectra and kernels.
+    Spectra and kernels are otherwise kept across calls to optics.resolve.
+    """
+    release_work_arrays()
+    SPECTRUM_CACHE.clear()
+    DOWNSAMPLED_PSF.clear()
+    SEPARABLE_PSF.clear()
+
+def reflect_pad(volume, half, dtype):
+    """
+    Pads the volume by reflection like numpy.pad(volume, half, 'reflect'),
+    into the 'padded' work array. The volume is converted to dtype while
+    being copied, and the borders are filled in place from the copy.
+
+    Args:
+        volume: numpy 3D array
+            the volume to pad
+        half: (z, x, y) integer tuple
+            the width of the border along each axis
+        dtype: numpy float type
+            the type of the padded volume
+    Returns:
+        padded: numpy 3D array
+            the padded volume, only valid until the next call
+    """
+    #Borders wider than the volume are reflected several times
+    if any(h >= s for h, s in zip(half, volume.shape)):
+        return np.pad(volume.astype(dtype, copy=False), [(h, h) for h in half], 'reflect')
+    padded = work_array('padded', tuple(s + 2 * h for s, h in zip(volume.shape, half)), dtype)
+    padded[tuple(slice(h, h + s) for h, s in zip(half, volume.shape))] = volume
+    #Axes are reflected one after the other over the whole padded volume,
+    #later axes overwrite the corners left by earlier ones
+    for axis, (h, s) in enumerate(zip(half, volume.shape)):
+        if h == 0:
+            continue
+        view = padded.swapaxes(0, axis)
+        view[:h] = view[2 * h:h:-1]
+        view[h + s:] = view[h + s - 2:s - 2:-1]
+    return padded
+
+def bin_planes(volume, z_step, xy_step, out=None):
+    """
+    Keeps one every z_step planes of the volume and sums its values over
+    bins of xy_step x xy_step pixels. Bins at the borders may be incomplete.
+    All planes are binned at once by reshaping them into blocks.
+
+    Args:
+        volume: numpy 3D array
+            the volume to sample
+        z_step: integer
+            one every z_step planes is kept, starting from the first one
+        xy_step: integer
+            the size of the bins in the x and y axis
+        out: numpy 3D array or None
+            optional buffer to write the result to, of the output shape
+    Returns:
+        out: numpy 3D array
+            the sampled volume, of shape (ceil(z / z_step), ceil(x / xy_step), ceil(y / xy_step))
+    """
+    volume = volume[::z_step]
+    (z, x, y) = volume.shape
+    w, h = -(-x // xy_step), -(-y // xy_step)
+    if out is None:
+        out = np.empty((z, w, h), volume.dtype)
+    #Full bins first, then the incomplete bins along the borders
+    x_parts = [(slice(0, x - x % xy_step), slice(0, x // xy_step)), (slice(x - x % xy_step, x), slice(x // xy_step, w))]
+    y_parts = [(slice(0, y - y % xy_step), slice(0, y // xy_step)), (slice(y - y % xy_step, y), slice(y // xy_step, h))]
+    for x_in, x_out in x_parts:
+        for y_in, y_out in y_parts:
+            block = volume[:, x_in, y_in]
+            bins = out[:, x_out, y_out]
+            if bins.size == 0:
+                continue
+            (_, bx, by) = bins.shape
+            bins[:] = block.reshape(z, bx, block.shape[1] // bx, by, block.shape[2] // by).sum(axis=(2, 4))
+    return out
+
+def fft_functions(fft_backend, fft_workers):
+    """
+    Returns the real forward and inverse N-dimensional FFTs of the given backend.
+
+    Args:
+        fft_backend: string
+            one of 'numpy', 'scipy' or 'pyfftw'
+        fft_workers: integer
+            number of threads to use, 0 uses all cores
+    Returns:
+        rfftn, irfftn: functions (array, shape, axes=None) -> array
+            the forward and inverse transforms over the given axes,
+            zero padding to shape
+    """
+    workers = fft_workers if fft_workers > 0 else cpu_count()
+    if fft_backend == 'pyfftw' and pyfftw is not None:
+        #Plans reuse their output array, so results are copied out
+        rfftn = lambda a, shape, axes=None:\
+                fftw_plan(pyfftw.builders.rfftn, a, shape, axes, workers)(a).copy()
+        irfftn = lambda a, shape, axes=None:\
+                 fftw_plan(pyfftw.builders.irfftn, a, shape, axes, workers)(a).copy()
+    elif fft_backend in ('scipy', 'pyfftw') and scipy_fft is not None:
+        rfftn = lambda a, shape, axes=None: scipy_fft.rfftn(a, shape, axes, workers=workers)
+        irfftn = lambda a, shape, axes=None: scipy_fft.irfftn(a, shape, axes, workers=workers)
+    else:
+        rfftn = lambda a, shape, axes=None: np.fft.rfftn(a, shape, axes)
+        irfftn = lambda a, shape, axes=None: np.fft.irfftn(a, shape, axes)
+    return rfftn, irfftn
+
+#FFTW plans, keyed by builder, input shape and type, output shape, axes and threads
+FFTW_PLANS = {}
+
+def fftw_plan(builder, a, shape, axes, workers):
+    """
+    Returns a cached FFTW plan for the given transform, input array and shape.
+    Planning is expensive, so plans are reused for arrays of the same shape.
+
+    Args:
+        builder: function
+            the pyfftw.builders function to use
+        a: numpy array
+            the input array
+        shape: integer tuple
+            the shape of the transform
+        axes: integer tuple or None
+            the axes to transform, all of them if None
+        workers: integer
+            number of threads to use
+    Returns:
+        plan: pyfftw.FFTW
+            a callable computing the transform of arrays like a
+    """
+    key = (builder, a.shape, a.dtype, shape, axes, workers)
+    if key not in FFTW_PLANS:
+        FFTW_PLANS[key] = builder(a, shape, axes, threads=workers, planner_effort='FFTW_MEASURE')
+    return FFTW_PLANS[key]
+
+def splat_voxel_work(psf_size):
+    """
+    Returns the work of splatting a single voxel, in psf voxels added.
+    Splatting loops over the voxels or over the psf taps, whichever is cheaper.
+
+    Args:
+        psf_size: integer
+            the number of voxels of the point spread function
+    Returns:
+        work: float
+            the amount of work per nonzero voxel
+    """
+    return float(min(SPLAT_OVERHEAD + psf_size, SPLAT_GATHER * psf_size))
+
+def splat_convolve(volume, psf_vol, dtype=np.float64):
+    """
+    Convolves the volume with the point spread function by adding
+    a scaled copy of the point spread function at each nonzero voxel.
+    Voxels close to the borders are reflected, which matches the output
+    of fft_convolve. Voxels are grouped by intensity so that each scaled
+    copy is computed once, and small point spread functions are added
+    one tap at a time to all voxels, see splat_voxel_work.
+
+    Args:
+        volume: numpy 3D array
+            the volume to convolve
+        psf_vol: numpy 3D float64 array
+            the point spread function, with odd dimensions
+        dtype: numpy float type
+            the precision to use, np.float32 or np.float64
+    Returns:
+        out: numpy 3D float array
+            the convolved volume, same shape as the input
+    """
+    (d, w, h) = psf_vol.shape
+    psf_vol = psf_vol.astype(dtype, copy=False)
+    half = np.array(psf_vol.shape) // 2
+    coords, values = reflect_points(volume, half)
+    #The psf centered on voxel p covers [p - half, p + half] which
+    #may start up to 2 * half before the volume for reflected voxels
+    margin = 2 * half
+    out = np.zeros(np.array(volume.shape) + 2 * margin, dtype)
+    coords = coords + half
+    if SPLAT_GATHER * psf_vol.size < SPLAT_OVERHEAD + psf_vol.size:
+        #The reflected voxels all have distinct coordinates, so shifting
+        #them by a tap never adds twice to the same output voxel
+        flat = out.reshape(-1)
+        starts = np.ravel_multi_index(tuple(coords.transpose()), out.shape)
+        #Sorted offsets make the scattered adds closer to sequential
+        order = np.argsort(starts)
+        starts, values = starts[order], values[order].astype(dtype)
+        for tap in np.transpose(np.nonzero(psf_vol)):
+            offset = np.ravel_multi_index(tuple(tap), out.shape)
+            flat[starts + offset] += values * psf_vol[tuple(tap)]
+    else:
+        levels, inverse = np.unique(values, return_inverse=True)
+        order = np.argsort(inverse, kind='mergesort')
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(levels)))
+        for level, group in zip(levels, np.split(coords[order], bounds[:-1])):
+            scaled = level * psf_vol
+            for (z, x, y) in group:
+                out[z:z + d, x:x + w, y:y + h] += scaled
+    (dz, dx, dy) = margin
+    return out[dz:dz + volume.shape[0], dx:dx + volume.shape[1], dy:dy + volume.shape[2]]
+
+def reflect_points(volume, half):
+    """
+    Lists the nonzero voxels of the volume along with their reflections
+    across the borders, as produced by numpy.pad(volume, half, 'reflect').
+
+    Args:
+        volume: numpy 3D array
+            the volume to read the nonzero voxels from
+        half: (z, x, y) integer tuple
+            the width of the reflected border along each axis
+    Returns:
+        coords: numpy 2D int64 array (n x 3)
+            the coordinates of the voxels, may be outside of the volume
+        values: numpy 1D array
+            the value of each voxel
+    """
+    coords = np.transpose(np.nonzero(volume)).astype(np.int64)
+    values = volume[tuple(coords.transpose())]
+    for axis, size in enumerate(volume.shape):
+        #Voxels within half of a border are mirrored, excluding the border itself
+        low = np.logical_and(coords[:, axis] >= 1, coords[:, axis] <= half[axis])
+        high = np.logical_and(coords[:, axis] >= size - 1 - half[axis], coords[:, axis] <= size - 2)
+        low_coords, high_coords = coords[low], coords[high]
+        low_coords[:, axis] = -low_coords[:, axis]
+        high_coords[:, axis] = 2 * (size - 1) - high_coords[:, axis]
+        coords = np.concatenate([coords, low_coords, high_coords])
+        values = np.concatenate([values, values[low], values[high]])
+    return coords, values
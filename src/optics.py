@@ -32,16 +32,36 @@ Set of methods to handle the simulation of the optical process.
 Implements confocal light microscopy.
 """
 
+import os
+import shutil
+import tempfile
 import numpy as np
 import psf
+from multiprocessing import Pool, cpu_count
+try:
+    import resource
+except ImportError:
+    resource = None
 from fluors import Fluorset
-from scipy.signal import fftconvolve
+from convolution import convolve, choose_method, nonzero_window, bin_planes, DTYPE,\
+                        downsample_psf, downsampling_error, work_array, release_work_arrays,\
+                        WORK_STATS
+import convolution
+
+#Default largest relative error accepted when convolving downsampled volumes
+DOWNSAMPLE_TOLERANCE = 0.1
+#Number of planes normalized at once
+NORMALIZE_PLANES = 8
+#Number of histogram bins per power of 2 used to estimate percentiles of photon counts
+STATS_BINS = 1024
 
 def resolve(labeled_volumes, volume_dim, voxel_dim, expansion_params, optics_params):
     """
     Resolves the labeled volumes with the given optics parameters.
     Performs photon count calculation, convolution with a point spread function,
     baseline noise and rescaling.
+    Channels are resolved in parallel if optics_params['processes'] is not 1,
+    each channel being seeded deterministically from the global random state.
 
     Args:
         labeled_volumes: dict fluorophore (string) -> volume (numpy 3D uint32 array)
@@ -55,53 +75,306 @@ def resolve(labeled_volumes, volume_dim, voxel_dim, expansion_params, optics_par
         optics_parameters: dict
             dicitonary containing the optics parameters
     Returns:
-        volumes: list of numpy 3D uint8 arrays
+        volumes: list of numpy 3D uint8 or uint16 arrays
             as list contianing a volume resolved for each channel
     """
-    #Create volume
-    volumes = []
-    #Resolve each channel one by one
-    #Make sure they're sorted by name for consistency
-    channels = sorted(optics_params['channels'].keys())
-    for channel in channels:
-        print "Resolving {}".format(channel)
+    return list(resolve_channels(labeled_volumes, volume_dim, voxel_dim, expansion_params,\
+                                 optics_params))
+
+def resolve_channels(labeled_volumes, volume_dim, voxel_dim, expansion_params, optics_params):
+    """
+    Resolves the labeled volumes like resolve, but yields the volume of each channel
+    as soon as it is resolved, so that it can be saved and released while the
+    next channels are resolved. Work arrays are released once the generator finishes
+    or is closed, point spread functions are kept for the next calls, see clear_caches.
+
+    Args:
+        labeled_volumes: dict fluorophore (string) -> volume (numpy 3D uint32 array)
+            dictionary containing the volumes to resolve
+        volume_dim: (z, x, y) integer tuple
+            dimensions of each volume in number of voxels
+        voxel_dim: (z, x, y) integer tuple
+            dimensions of a voxel in nm
+        expansion_parameters: dict
+            dicitonary containing the expansion parameters
+        optics_parameters: dict
+            dicitonary containing the optics parameters
+    Returns:
+        volumes: generator of numpy 3D uint8 or uint16 arrays
+            the volume resolved for each channel, in the order of the channel names
+    """
+    try:
+        #Make sure they're sorted by name for consistency
+        channels = sorted(optics_params['channels'].keys())
+        #Excitation and emission psfs are shared by channels, compute them all at once
+        precompute_psfs(sorted(labeled_volumes), voxel_dim, expansion_params['factor'],\
+                        optics_params)
+        _, xy_scale = scale_factors(voxel_dim, expansion_params['factor'], **optics_params)
+        if xy_scale > 1:
+            print "Warning: the ground truth resolution is too low to resolve the volume with the desired expansion. Attempting a work around."
+        seeds = np.random.randint(0, 2**31 - 1, size=len(channels))
+        processes = optics_params.get('processes', 1)
+        processes = min(processes if processes > 0 else cpu_count(), len(channels))
+        if processes > 1:
+            for volume in resolve_parallel(labeled_volumes, volume_dim, voxel_dim,\
+                                           expansion_params, optics_params, channels, seeds,\
+                                           processes):
+                yield volume
+            return
+        #Resolve each channel one by one, reusing the same buffer for scaling
+        buffer = np.empty(scaled_shape(volume_dim, voxel_dim, expansion_params['factor'],\
+                                       **optics_params), np.uint32)
+        for channel, seed in zip(channels, seeds):
+            yield resolve_channel(labeled_volumes, volume_dim, voxel_dim, expansion_params,\
+                                  optics_params, channel, seed, buffer)
+    finally:
+        #Work arrays are as large as the volumes, psfs and their spectra are reused by later calls
+        release_work_arrays()
+
+def resolve_channel(labeled_volumes, volume_dim, voxel_dim, expansion_params, optics_params,\
+                    channel, seed, buffer=None, out=None):
+    """
+    Resolves the labeled volumes in a single channel.
+
+    Args:
+        labeled_volumes: dict fluorophore (string) -> volume (numpy 3D uint32 array)
+            dictionary containing the volumes to resolve
+        volume_dim: (z, x, y) integer tuple
+            dimensions of each volume in number of voxels
+        voxel_dim: (z, x, y) integer tuple
+            dimensions of a voxel in nm
+        expansion_parameters: dict
+            dicitonary containing the expansion parameters
+        optics_parameters: dict
+            dicitonary containing the optics parameters
+        channel: string
+            the name of the channel to resolve, a key of optics_params['channels']
+        seed: integer
+            seed for the random number generator
+        buffer: numpy 3D uint32 array or None
+            optional buffer used to scale the volume, of the output shape
+        out: numpy 3D array or None
+            optional array in which to write the normalized volume, of the output shape
+            and type
+    Returns:
+        channel_vol: numpy 3D uint8 or uint16 array
+            the volume resolved in the given channel
+    """
+    print "Resolving {}".format(channel)
+    #A local generator leaves the global numpy random state untouched
+    rng = np.random.RandomState(seed)
+    fluorset = Fluorset()
+    channel_params = optics_params['channels'][channel]
+    #Merge parameters
+    params = optics_params.copy()
+    params.update(channel_params)
+    z_step, xy_scale = scale_factors(voxel_dim, expansion_params['factor'], **params)
+    #When downsampling, baseline noise is drawn directly on the output sampling grid
+    downsampling = xy_scale <= 1
+    xy_step = int(np.round(1.0 / xy_scale)) if downsampling else 1
+    #When fused, the convolution is only computed on the output sampling grid
+    fused = params.get('fused_scaling', False) and downsampling
+    if params.get('fused_scaling', False) and not downsampling:
+        print "Warning: fused scaling only applies when downsampling, scaling separately."
+    #Photons may also be binned to the output pixels before convolving
+    coarse = params.get('downsample_convolution', False) and xy_step > 1
+    fused = fused or coarse
+    if fused:
+        channel_vol = np.zeros(scaled_shape(volume_dim, voxel_dim, expansion_params['factor'],\
+                                            **params), np.uint32)
+    else:
         channel_vol = np.zeros(volume_dim, np.uint32)
-        channel_params = optics_params['channels'][channel]
-        #Each fluorophore may produce photons in the given channel
-        for fluorophore in labeled_volumes:
-            #Merge parameters
-            params = optics_params.copy()
-            params.update(channel_params)
-            #Compute photon count
-            mean_photon = mean_photons(fluorophore, **params)
-            #Only spend time convolving if the fluorophore is not orthogonal to
-            #this channel
-            if mean_photon > 0:
-                fluo_vol = np.zeros(volume_dim, np.float64)
-                Z, X, Y = np.nonzero(labeled_volumes[fluorophore])
-                photons = np.random.poisson(mean_photon, size = len(Z)).astype(np.uint32)
-                photons = np.multiply(labeled_volumes[fluorophore][Z, X, Y], photons)
-                np.add.at(fluo_vol, (Z, X, Y), photons)
-                #Convolve with point spread
-                psf_vol = psf_volume(voxel_dim, expansion_params['factor'], fluorophore, **params)
-                (d, w, h) = psf_vol.shape
-                #Resize fluo_vol for convolution
-                fluo_vol = np.pad(fluo_vol, ((d / 2, d /2), (w / 2, w /2), (h / 2, h / 2)), 'reflect')
-                channel_vol += np.round(fftconvolve(fluo_vol, psf_vol, 'valid')).astype(np.uint32)
-        #Add noise
-        channel_vol += baseline_volume(channel_vol.shape, **optics_params)
-        #Optical scaling
-        channel_vol = scale(channel_vol, voxel_dim, expansion_params['factor'], **optics_params)
-        #Normalize
-        channel_vol = normalize(channel_vol)
-        volumes.append(channel_vol)
-
-    return volumes
+    #Fluorophores with the same emission peak share the same point spread
+    #function. Convolution is linear, so their photons are convolved together.
+    #Photons are kept as lists of voxels until their peak is convolved
+    photon_vols = {}
+    dtype = DTYPE[params.get('precision', 'double')]
+    #Each fluorophore may produce photons in the given channel
+    for fluorophore in sorted(labeled_volumes):
+        #Compute photon count
+        mean_photon = mean_photons(fluorophore, **params)
+        #Only spend time convolving if the fluorophore is not orthogonal to
+        #this channel
+        if mean_photon > 0:
+            peak = fluorset.get_fluor(fluorophore).find_emission_peak()
+            fluorophores, voxels = photon_vols.setdefault(peak, ([], []))
+            fluorophores.append(fluorophore)
+            Z, X, Y = np.nonzero(labeled_volumes[fluorophore])
+            photons = rng.poisson(mean_photon, size = len(Z)).astype(np.uint32)
+            photons = np.multiply(labeled_volumes[fluorophore][Z, X, Y], photons)
+            voxels.append(((Z, X, Y), photons))
+    for peak in sorted(photon_vols):
+        fluorophores, voxels = photon_vols.pop(peak)
+        #The photon volume is written to the same work array for every peak
+        fluo_vol = work_array('photons', volume_dim, dtype)
+        fluo_vol.fill(0)
+        for coords, photons in voxels:
+            np.add.at(fluo_vol, coords, photons)
+        del voxels
+        #Convolve with point spread
+        psf_vol = psf_volume(voxel_dim, expansion_params['factor'], fluorophores[0], **params)
+        #Steps of the sampling done by the convolution
+        steps = (z_step, xy_step, xy_step) if fused else (1, 1, 1)
+        if coarse:
+            error = downsampling_error(fluo_vol, psf_vol, xy_step, **params)
+            if error <= params.get('downsample_tolerance', DOWNSAMPLE_TOLERANCE):
+                print "Downsampling {} by {} before convolving ({:.1%} error)".format(\
+                        ', '.join(fluorophores), xy_step, error)
+                fluo_vol = bin_planes(fluo_vol, 1, xy_step)
+                psf_vol = downsample_psf(psf_vol, xy_step)
+                steps = (z_step, 1, 1)
+            else:
+                print "Warning: downsampling {} is not accurate enough ({:.1%} error), "\
+                      "convolving at full resolution.".format(', '.join(fluorophores), error)
+        #Only convolve the labeled part of the volume
+        window = nonzero_window(fluo_vol, psf_vol.shape, steps[0], steps[1])
+        if window is None:
+            continue
+        size = float(fluo_vol.size)
+        fluo_vol = fluo_vol[window]
+        #Pick the cheapest convolution method, unless one is configured
+        method = choose_method(fluo_vol, psf_vol, params.get('convolution', 'auto'))
+        print "Convolving {} using {} ({} nonzero voxels, {:.1%} of the volume)".format(\
+                ', '.join(fluorophores), method, np.count_nonzero(fluo_vol),\
+                fluo_vol.size / size)
+        conv = convolve(fluo_vol, psf_vol, method, steps[0], steps[1], **params)
+        #Add the convolved window at its location in the channel volume
+        window = tuple(slice(w.start // step, w.start // step + n)\
+                       for w, step, n in zip(window, steps, conv.shape))
+        #Round in place and accumulate without intermediate copies
+        np.rint(conv, out=conv)
+        np.add(channel_vol[window], conv, out=channel_vol[window], casting='unsafe')
+    #Add noise
+    if not downsampling:
+        channel_vol += baseline_volume(volume_dim, rng=rng, **optics_params)
+    #Optical scaling
+    if not fused:
+        channel_vol = scale(channel_vol, voxel_dim, expansion_params['factor'], out=buffer,\
+                            rng=rng, **optics_params)
+    if downsampling:
+        channel_vol += baseline_volume(volume_dim, z_step=z_step, xy_step=xy_step, rng=rng,\
+                                       **optics_params)
+    memory_report(channel)
+    #Normalize
+    return normalize(channel_vol, params.get('normalization_percentile', 100.0),\
+                     np.dtype(params.get('output_type', 'uint8')), out)
+
+def memory_report(channel):
+    """
+    Prints the peak memory used by the process so far, and the number
+    of work arrays allocated compared to the number requested.
+
+    Args:
+        channel: string
+            the name of the channel just resolved
+    """
+    usage = "{} work arrays allocated so far for {} requests".format(\
+            WORK_STATS['allocations'], WORK_STATS['requests'])
+    #Peak resident memory is only available on Unix, in kilobytes on Linux
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage = "peak memory {:.1f} MB, ".format(peak / 1024.0) + usage
+    print "Resolved {}: {}".format(channel, usage)
+
+def resolve_parallel(labeled_volumes, volume_dim, voxel_dim, expansion_params, optics_params,\
+                     channels, seeds, processes):
+    """
+    Resolves the channels concurrently using a pool of processes.
+    The labeled volumes are written to memory mapped files, which workers read
+    without copying, and each worker writes its channel in a shared output file.
+    Channels are yielded in order, as soon as they and the previous ones are resolved.
+
+    Args:
+        labeled_volumes: dict fluorophore (string) -> volume (numpy 3D uint32 array)
+            dictionary containing the volumes to resolve
+        volume_dim: (z, x, y) integer tuple
+            dimensions of each volume in number of voxels
+        voxel_dim: (z, x, y) integer tuple
+            dimensions of a voxel in nm
+        expansion_parameters: dict
+            dicitonary containing the expansion parameters
+        optics_parameters: dict
+            dicitonary containing the optics parameters
+        channels: list of strings
+            the channels to resolve
+        seeds: list of integers
+            the seed to use for each channel
+        processes: integer
+            the number of worker processes
+    Returns:
+        volumes: generator of numpy 3D uint8 or uint16 arrays
+            the volume resolved for each channel
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        paths = {}
+        for fluorophore, volume in labeled_volumes.items():
+            paths[fluorophore] = os.path.join(tmp_dir, fluorophore + '.npy')
+            np.save(paths[fluorophore], volume)
+        out_dim = scaled_shape(volume_dim, voxel_dim, expansion_params['factor'], **optics_params)
+        out_path = os.path.join(tmp_dir, 'out.npy')
+        out = np.lib.format.open_memmap(out_path, 'w+', np.dtype(optics_params.get('output_type',\
+                                        'uint8')), (len(channels),) + out_dim)
+        del out
+        tasks = [(paths, volume_dim, voxel_dim, expansion_params, optics_params, channel, seed,\
+                  out_path, i) for i, (channel, seed) in enumerate(zip(channels, seeds))]
+        pool = Pool(processes)
+        try:
+            for i in pool.imap(resolve_worker, tasks):
+                out = np.load(out_path, mmap_mode='r')
+                yield np.array(out[i])
+                del out
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def resolve_worker(task):
+    """
+    Resolves a single channel in a worker process, see resolve_parallel.
+
+    Args:
+        task: tuple
+            the paths to the labeled volumes, the arguments of resolve_channel,
+            the path to the output file and the index of the channel in it
+    Returns:
+        i: integer
+            the index of the channel, once written
+    """
+    paths, volume_dim, voxel_dim, expansion_params, optics_params, channel, seed, out_path, i = task
+    labeled_volumes = {f: np.load(path, mmap_mode='r') for f, path in paths.items()}
+    #The channel is normalized directly in the output file
+    out = np.load(out_path, mmap_mode='r+')
+    resolve_channel(labeled_volumes, volume_dim, voxel_dim, expansion_params, optics_params,\
+                    channel, seed, out=out[i])
+    out.flush()
+    return i
+
+#Point spread volumes already computed, keyed by their parameters
+PSF_CACHE = {}
+#Excitation and emission psfs in z, r space, keyed by type, wavelength and geometry.
+#They are shared by the point spread functions of all channels and fluorophores
+COMPONENT_PSF_CACHE = {}
+
+def clear_caches():
+    """
+    Releases the cached point spread functions and their spectra, as well as the work
+    arrays of convolution. Psfs are otherwise kept across calls to resolve, so that
+    simulations repeated with the same optics, like sequencing rounds, reuse them.
+    """
+    PSF_CACHE.clear()
+    COMPONENT_PSF_CACHE.clear()
+    convolution.clear_caches()
 
 def psf_volume(voxel_dim, expansion, fluorophore, laser_wavelength, numerical_aperture,\
-                refractory_index, pinhole_radius, objective_factor, type, **kwargs):
+                refractory_index, pinhole_radius, objective_factor, type, psf_energy=0.999, **kwargs):
     """
     Creates a point spread volume, using the given parameters.
+    The volume is cropped to the smallest extent holding the given fraction of its energy,
+    and voxels may have different sizes in x and y.
+    Volumes are cached, so the same array is returned for identical parameters
+    and fluorophores with the same emission peak. It should not be modified.
 
     Args:
         voxel_dim: (z, x, y) tuple
@@ -122,72 +395,356 @@ def psf_volume(voxel_dim, expansion, fluorophore, laser_wavelength, numerical_ap
             objective factor of the microscope, tipically 0, 20 or 40
         type: string
             one of 'confocal', 'widefield' or 'two photon'
+        psf_energy: float
+            the fraction of the energy of the point spread function to keep,
+            see crop_psf
     Returns:
         psf_vol: numpy 3d float64 array
             the point spread function
     """
     fluorset = Fluorset()
     f = fluorset.get_fluor(fluorophore)
+    em_wavelen = f.find_emission_peak()
+    key = (tuple(voxel_dim), expansion, laser_wavelength, em_wavelen, numerical_aperture,\
+           refractory_index, pinhole_radius, objective_factor, type, psf_energy)
+    if key in PSF_CACHE:
+        return PSF_CACHE[key]
     #Map to psf type
     psf_type = {'confocal': psf.CONFOCAL, 'widefield': psf.WIDEFIELD, 'two photon': psf.TWOPHOTON}
-    #Upper bound for psf size
-    precision = 16
     z, x, y = np.array(voxel_dim) * expansion
     #Arguments
     back_projected_radius = pinhole_radius / float(objective_factor)
+    shape, dims = psf_grid(voxel_dim, expansion)
     #Fill args in dictionary
-    args = dict(shape=(precision, precision), dims=(precision * z * 1e-3, precision * x * 1e-3),\
-                ex_wavelen=laser_wavelength, em_wavelen=f.find_emission_peak(),\
+    args = dict(shape=shape, dims=dims,\
+                ex_wavelen=laser_wavelength, em_wavelen=em_wavelen,\
                 num_aperture=numerical_aperture, refr_index=refractory_index,\
                 pinhole_radius=back_projected_radius, magnification = 1)
-    #Compute psf
-    psf_vol = psf.PSF(psf.ISOTROPIC | psf_type[type], **args)
-    return psf_vol.volume()
+    #Compute psf from the excitation psf of the laser and the emission psf of the peak
+    expsf = component_psf(psf.EXCITATION, laser_wavelength, **args)
+    if type == 'two photon':
+        data = expsf.data * expsf.data
+    else:
+        empsf = component_psf(psf.EMISSION, em_wavelen, **args)
+        data = psf.PSF(psf.ISOTROPIC | psf_type[type], expsf=expsf, empsf=empsf, **args).data
+    psf_vol = radial_volume(data, min(x, y), (x, y), PSF_PRECISION)
+    PSF_CACHE[key] = crop_psf(psf_vol, psf_energy)
+    return PSF_CACHE[key]
 
-def baseline_volume(volume_dim, baseline_noise, **kwargs):
+#Upper bound for psf size, in voxels from the center
+PSF_PRECISION = 16
+
+def psf_grid(voxel_dim, expansion):
+    """
+    Returns the sampling of point spread functions in z, r space.
+    The radius is sampled with the smallest of the x and y voxel sizes,
+    far enough to cover both axes.
+
+    Args:
+        voxel_dim: (z, x, y) tuple
+            the dimensions of a voxel in nm
+        expansion: float
+            the expansion factor
+    Returns:
+        shape: (z, r) integer tuple
+            the number of samples along z and r
+        dims: (z, r) float tuple
+            the extent of the samples in micrometers
+    """
+    z, x, y = np.array(voxel_dim) * expansion
+    r_step = min(x, y)
+    r_size = int(np.ceil(PSF_PRECISION * max(x, y) / r_step))
+    return (PSF_PRECISION, r_size), (PSF_PRECISION * z * 1e-3, r_size * r_step * 1e-3)
+
+def precompute_psfs(fluorophores, voxel_dim, expansion, optics_params):
+    """
+    Computes the excitation and emission psfs used by resolve_channel, each in a single
+    batch, and stores them in COMPONENT_PSF_CACHE. Only the (fluorophore, channel) pairs
+    producing photons are convolved, so only their lasers and emission peaks are computed.
+
+    Args:
+        fluorophores: list of strings
+            the fluorophores of the labeled volumes
+        voxel_dim: (z, x, y) integer tuple
+            dimensions of a voxel in nm
+        expansion: float
+            the expansion factor
+        optics_parameters: dict
+            dicitonary containing the optics parameters
+    """
+    fluorset = Fluorset()
+    shape, dims = psf_grid(voxel_dim, expansion)
+    lasers, peaks = set(), set()
+    for channel_params in optics_params['channels'].values():
+        params = optics_params.copy()
+        params.update(channel_params)
+        for fluorophore in fluorophores:
+            if mean_photons(fluorophore, **params) > 0:
+                lasers.add(params['laser_wavelength'])
+                peaks.add(fluorset.get_fluor(fluorophore).find_emission_peak())
+    batches = [(psf.EXCITATION, lasers)]
+    if optics_params['type'] != 'two photon':
+        batches.append((psf.EMISSION, peaks))
+    for psftype, wavelengths in batches:
+        args = (tuple(shape), tuple(dims), optics_params['numerical_aperture'],\
+                optics_params['refractory_index'])
+        missing = sorted(w for w in wavelengths if (psftype, w) + args not in COMPONENT_PSF_CACHE)
+        if not missing:
+            continue
+        psfs = psf.psf_batch(psftype, missing, shape, dims, num_aperture=args[2],\
+                             refr_index=args[3])
+        for wavelength, psf_obj in zip(missing, psfs):
+            COMPONENT_PSF_CACHE[(psftype, wavelength) + args] = psf_obj
+
+def component_psf(psftype, wavelength, shape, dims, num_aperture, refr_index, **kwargs):
+    """
+    Returns the excitation or emission point spread function for the given wavelength.
+    Functions are cached, as the same excitation is used by all fluorophores of a channel
+    and the same emission by all channels a fluorophore is excited in.
+
+    Args:
+        psftype: integer
+            psf.EXCITATION or psf.EMISSION
+        wavelength: int
+            the excitation or emission wavelength in nm
+        shape: (z, r) integer tuple
+            the number of samples of the function
+        dims: (z, r) float tuple
+            the extent of the function in micrometers
+        num_aperture: float
+            the numerical aperture of the system
+        refr_index: float
+            the refractory index of the medium
+    Returns:
+        psf_obj: psf.PSF
+            the point spread function in z, r space
+    """
+    key = (psftype, wavelength, tuple(shape), tuple(dims), num_aperture, refr_index)
+    if key not in COMPONENT_PSF_CACHE:
+        name = 'ex_wavelen' if psftype == psf.EXCITATION else 'em_wavelen'
+        wavelengths = {name: wavelength}
+        COMPONENT_PSF_CACHE[key] = psf.PSF(psf.ISOTROPIC | psftype, shape=shape, dims=dims,\
+                                           num_aperture=num_aperture, refr_index=refr_index,\
+                                           **wavelengths)
+    return COMPONENT_PSF_CACHE[key]
+
+def radial_volume(data, r_step, xy_dim, size):
+    """
+    Applies rotational symmetry to a point spread function given in z, r space,
+    on a grid of voxels which may have different sizes in x and y.
+    Values are linearly interpolated along the radius, like psf.PSF.volume.
+
+    Args:
+        data: numpy 2D float64 array
+            the point spread function in z, r space
+        r_step: float
+            the radius step between two values of data, in nm
+        xy_dim: (x, y) tuple
+            the dimensions of a voxel in x and y, in nm
+        size: integer
+            the number of voxels from the center to the border, in x and y
+    Returns:
+        psf_vol: numpy 3d float64 array
+            the point spread function, with odd dimensions
+    """
+    (dimz, dimr) = data.shape
+    X = np.arange(size)[:, np.newaxis] * float(xy_dim[0])
+    Y = np.arange(size)[np.newaxis, :] * float(xy_dim[1])
+    r = np.sqrt(X**2 + Y**2) / r_step
+    ri = np.floor(r).astype(np.int64)
+    rf = r - ri
+    outside = ri >= dimr
+    ri = np.minimum(ri, dimr - 1)
+    rn = np.minimum(ri + 1, dimr - 1)
+    quadrant = data[:, ri] + rf * (data[:, rn] - data[:, ri])
+    quadrant[:, outside] = 0
+    return psf.mirror_symmetry(quadrant)
+
+def crop_psf(psf_vol, energy):
+    """
+    Crops the point spread function to the smallest centered box holding
+    at least the given fraction of its energy. The tails left out of the
+    box along each axis hold at most a third of the remaining energy.
+    The z axis is cropped with the same criterion as x and y, but the sampled
+    z extent (PSF_PRECISION slices) is usually shorter than the axial spread
+    of the psf, so z is only cropped for thick voxels or lower energies.
+    With the default energy of 0.999 most kernels are kept whole, lower values
+    such as 0.99 trim the lateral tails of confocal and widefield kernels.
+
+    Args:
+        psf_vol: numpy 3d float64 array
+            the point spread function, with odd dimensions
+        energy: float
+            the fraction of the energy to keep, 1.0 keeps the whole volume
+    Returns:
+        psf_vol: numpy 3d float64 array
+            the cropped point spread function, with odd dimensions
+    """
+    if energy >= 1.0:
+        return psf_vol
+    total = psf_vol.sum()
+    window = []
+    for axis in range(3):
+        profile = psf_vol.sum(axis=tuple(a for a in range(3) if a != axis))
+        c = len(profile) // 2
+        #Energy within each distance of the center
+        inside = profile[c] + np.concatenate([[0], np.cumsum(profile[c + 1:] + profile[c - 1::-1])])
+        half = np.argmax(inside >= total * (1 - (1 - energy) / 3.0))
+        window.append(slice(c - half, c + half + 1))
+    return psf_vol[tuple(window)].copy()
+
+def baseline_volume(volume_dim, baseline_noise, z_step=1, xy_step=1, rng=np.random, **kwargs):
     """
     Creates a volume of baseline photon noise, using a poisson distribution
     multiplied by a gaussian to mimic the light focus towards the center of the image.
+    The noise may be drawn directly on a sampled grid, where each pixel sums
+    the noise of a bin of voxels as computed by convolution.bin_planes.
 
     Args:
         volume_dim: (z, x, y) integer tuple
-            the size of the volume to create
+            the size of the volume before sampling
         baseline_noise: integer
             the mean number of photons of the poisson distribution
+        z_step: integer
+            one every z_step slices is kept
+        xy_step: integer
+            the size of the bins in the x and y axis
+        rng: numpy.random.RandomState
+            the random number generator to draw the noise from
     Returns:
         out: numpy 3D uint32 array
             a volume of basline photon noise
     """
     (d, w, h) = volume_dim
-    indices = np.indices((d, w, h), dtype=np.float64)
-    gaussian = np.exp(-((indices[1] - w / 2.0)**2 / (0.5 * w**2) + (indices[2] - h / 2.0)**2 / (0.5 * h**2)))
-    out = np.round(np.multiply(np.random.poisson(baseline_noise, size=volume_dim), gaussian))
+    #The gaussian only depends on x and y
+    x = np.arange(w, dtype=np.float64)[:, np.newaxis]
+    y = np.arange(h, dtype=np.float64)[np.newaxis, :]
+    gaussian = np.exp(-((x - w / 2.0)**2 / (0.5 * w**2) + (y - h / 2.0)**2 / (0.5 * h**2)))
+    #Each bin sums the photons of its voxels, weighted by their mean gaussian
+    gaussian = bin_planes(gaussian[np.newaxis], 1, xy_step)[0]
+    counts = bin_planes(np.ones((1, w, h)), 1, xy_step)[0]
+    photons = rng.poisson(baseline_noise * counts, size=(len(range(0, d, z_step)),) + counts.shape)
+    out = np.round(np.multiply(photons, gaussian / counts))
     return out.astype(np.uint32)
 
-def normalize(volume):
+def normalize(volume, percentile=100.0, dtype=np.uint8, out=None):
     """
-    Normalizes the volume to the [0, 255] range by dividing by the maximum value.
+    Normalizes the volume to the range of the output type, by dividing by the maximum value
+    or by a percentile of the values. The volume is read twice, a few planes at a time:
+    once to compute its statistics and once to normalize it, see IntensityStats and
+    apply_normalization.
 
     Args:
         volume: 3D numpy array, np.uint32
             the volume to normalize
+        percentile: float
+            the percentile mapped to the largest output value, values above it saturate
+        dtype: numpy integer type
+            the output type, np.uint8 or np.uint16
+        out: 3D numpy array or None
+            optional array in which to write the normalized volume, of the given type
     Returns:
-        normalized:3D numpy array, np.uint8
+        normalized:3D numpy array, of the given type
             the normalized volume
     """
-    max = np.amax(volume)
-    if max == 0:#Fixes dividing by 0 error if nothing in the volume
-        return volume.astype(np.uint8)
+    stats = IntensityStats(histogram=percentile < 100)
+    for z in range(0, volume.shape[0], NORMALIZE_PLANES):
+        stats.update(volume[z:z + NORMALIZE_PLANES])
+    return apply_normalization(volume, stats.percentile(percentile), dtype, out)
+
+def apply_normalization(volume, white, dtype=np.uint8, out=None):
+    """
+    Maps the [0, white] range of the volume to the range of the output type, a few planes at
+    a time. The same white level can be used for all the chunks or tiles of a volume.
+
+    Args:
+        volume: 3D numpy array, np.uint32
+            the volume to normalize
+        white: integer
+            the value mapped to the largest output value, larger values saturate
+        dtype: numpy integer type
+            the output type
+        out: 3D numpy array or None
+            optional array in which to write the normalized volume, of the given type
+    Returns:
+        out: 3D numpy array, of the given type
+            the normalized volume
+    """
+    if out is None:
+        out = np.empty(volume.shape, dtype)
+    top = np.iinfo(out.dtype).max
+    #Fixes dividing by 0 error if nothing in the volume
+    factor = top / float(max(white, 1))
+    for z in range(0, volume.shape[0], NORMALIZE_PLANES):
+        chunk = volume[z:z + NORMALIZE_PLANES] * factor
+        np.rint(chunk, out=chunk)
+        np.minimum(chunk, top, out=chunk)
+        out[z:z + NORMALIZE_PLANES] = chunk
+    return out
+
+class IntensityStats(object):
+    """
+    Statistics of photon counts, updated chunk by chunk: the maximum, and optionally
+    a histogram used to estimate percentiles. Histogram bins are evenly spaced on a log
+    scale, STATS_BINS per power of 2, so percentiles are found within a relative
+    error of 2^(1 / STATS_BINS) - 1, whatever the range of the counts.
+    """
+
+    def __init__(self, histogram=False):
+        """
+        Args:
+            histogram: boolean
+                whether to compute the histogram, needed for percentiles below 100
+        """
+        self.max = 0
+        #Photon counts are at most 32 bits integers
+        self.histogram = np.zeros(33 * STATS_BINS, np.int64) if histogram else None
+
+    def update(self, chunk):
+        """
+        Adds the values of a chunk to the statistics.
+
+        Args:
+            chunk: numpy integer array
+                the values to add
+        """
+        if chunk.size == 0:
+            return
+        self.max = max(self.max, int(np.amax(chunk)))
+        if self.histogram is None:
+            return
+        bins = np.log2(chunk.ravel() + 1.0)
+        bins *= STATS_BINS
+        self.histogram += np.bincount(bins.astype(np.intp), minlength=self.histogram.size)
 
-    normalized = volume * (255.0 / max)
-    normalized = np.round(normalized).astype(np.uint8)
-    return normalized
+    def percentile(self, q):
+        """
+        Estimates a percentile of the values.
+
+        Args:
+            q: float
+                the percentile, between 0 and 100
+        Returns:
+            value: integer
+                the largest integer in the histogram bin containing the percentile,
+                or the maximum if q is 100
+        """
+        if q >= 100 or self.histogram is None:
+            return self.max
+        cumulative = np.cumsum(self.histogram)
+        if cumulative[-1] == 0:
+            return 0
+        index = np.searchsorted(cumulative, q / 100.0 * cumulative[-1])
+        upper = int(np.ceil(2 ** ((index + 1.0) / STATS_BINS) - 1)) - 1
+        return min(max(upper, 0), self.max)
 
 def scale(volume, voxel_dim, expansion, objective_factor,
-          pixel_size, focal_plane_depth, **kwargs):
+          pixel_size, focal_plane_depth, out=None, rng=np.random, **kwargs):
     """
     Scales the output volume with the appropriate optics parameters
     using nearest neighbour interpolation.
+    All kept slices are scaled at once. When downsampling, pixels are summed
+    over bins of an integer size, see convolution.bin_planes.
 
     Args:
         volume: numpy 3D array (z, x, y)
@@ -202,39 +759,115 @@ def scale(volume, voxel_dim, expansion, objective_factor,
             the size of a pixel in the microscope, in nm
         focal_plane_depth: integer
             the thickness of a slice in nm
+        out: numpy 3D uint32 array or None
+            optional buffer to write the scaled volume to, of the output shape
+        rng: numpy.random.RandomState
+            the random number generator used to jitter upsampled voxels
     Returns:
         out: numpt 3D array
             the scaled volume in all three axis
     """
+    z_step, xy_scale = scale_factors(voxel_dim, expansion, objective_factor,\
+                                     pixel_size, focal_plane_depth)
+    if xy_scale <= 1:
+        return bin_planes(volume, z_step, int(np.round(1.0 / xy_scale)), out)
+    planes = volume[::z_step]
+    d = planes.shape[0]
+    w, h = scaled_size(volume.shape[1], xy_scale), scaled_size(volume.shape[2], xy_scale)
+    Z, X, Y = np.nonzero(planes)
+    values = planes[Z, X, Y]
+    #Rescale and round
+    X = np.floor(xy_scale * X).astype(np.int64)
+    Y = np.floor(xy_scale * Y).astype(np.int64)
+    #Adding poisson since the volume is expanded, to avoid grid-like images
+    X = np.clip(X + rng.poisson(int(xy_scale), size = len(X)), 0, w - 1)
+    Y = np.clip(Y + rng.poisson(int(xy_scale), size = len(Y)), 0, h - 1)
+    #Bincount sums the values of repeated indices
+    indices = np.ravel_multi_index((Z, X, Y), (d, w, h))
+    if out is None:
+        out = np.empty((d, w, h), np.uint32)
+    out[:] = np.bincount(indices, weights=values, minlength=d * w * h).reshape(d, w, h)
+    return out
+
+def scale_factors(voxel_dim, expansion, objective_factor, pixel_size, focal_plane_depth, **kwargs):
+    """
+    Computes the sampling of the output volume with the appropriate optics parameters.
+
+    Args:
+        voxel_dim: (z, x, y) tuple
+            the dimensions of a voxel in nm
+        expansion: float
+            the expansion factor
+        objective_factor: float
+            objective factor of the microscope, tipically 0, 20 or 40
+        pixel_size: integer
+            the size of a pixel in the microscope, in nm
+        focal_plane_depth: integer
+            the thickness of a slice in nm
+    Returns:
+        z_step: integer
+            one every z_step slices is kept
+        xy_scale: float
+            the scaling factor in the x and y axis
+    """
     xy_step = float(pixel_size) / (voxel_dim[1] * expansion * objective_factor)
     #This removes rounding artifacts, by binning with an integer number of pixels
     if xy_step < 1:
         xy_scale = 1.0 / xy_step
         xy_scale = np.round(xy_scale)
-        print "Warning: the ground truth resolution is too low to resolve the volume with the desired expansion. Attempting a work around."
     else:
         xy_step = np.round(xy_step)
         xy_scale = 1.0 / xy_step
     z_scale = voxel_dim[0] * expansion / float(focal_plane_depth)
     z_step = np.round(1.0 / z_scale).astype(np.int)
-    out = []
-    for i in range(0, volume.shape[0], z_step):
-        X, Y = np.nonzero(volume[i, :, :])
-        values = volume[i, X, Y]
-        #Rescale and round
-        X = np.floor(xy_scale * X).astype(np.int64)
-        Y = np.floor(xy_scale * Y).astype(np.int64)
-        #Create new image
-        d, w, h = np.ceil(np.array(volume.shape) * xy_scale)
-        im = np.zeros((int(w), int(h)), np.uint32)
-        #Adding poisson if the volume is expanded, to avoid grid-like images
-        if xy_scale > 1:
-            X = np.clip(X + np.random.poisson(int(xy_scale), size = len(X)), 0, w - 1)
-            Y = np.clip(Y + np.random.poisson(int(xy_scale), size = len(Y)), 0, h - 1)
-        #This allows to add to repetition of the same index
-        np.add.at(im, (X.astype(np.uint64), Y.astype(np.uint64)), values)
-        out.append(im)
-    return np.array(out)
+    return z_step, xy_scale
+
+def scaled_shape(volume_dim, voxel_dim, expansion, objective_factor,
+                 pixel_size, focal_plane_depth, **kwargs):
+    """
+    Computes the shape of a volume after scaling, see scale.
+
+    Args:
+        volume_dim: (z, x, y) integer tuple
+            the dimensions of the volume before scaling
+        voxel_dim: (z, x, y) tuple
+            the dimensions of a voxel in nm
+        expansion: float
+            the expansion factor
+        objective_factor: float
+            objective factor of the microscope, tipically 0, 20 or 40
+        pixel_size: integer
+            the size of a pixel in the microscope, in nm
+        focal_plane_depth: integer
+            the thickness of a slice in nm
+    Returns:
+        out_dim: (z, x, y) integer tuple
+            the dimensions of the scaled volume
+    """
+    z_step, xy_scale = scale_factors(voxel_dim, expansion, objective_factor,\
+                                     pixel_size, focal_plane_depth)
+    (d, w, h) = volume_dim
+    return (int(np.ceil(d / float(z_step))), scaled_size(w, xy_scale), scaled_size(h, xy_scale))
+
+def scaled_size(size, xy_scale):
+    """
+    Computes the size of the x or y axis after scaling, see scale. When downsampling,
+    the size is computed from the integer bin size like convolution.bin_planes, as
+    the product with xy_scale may be rounded up past a whole number of bins.
+
+    Args:
+        size: integer
+            the size of the axis before scaling
+        xy_scale: float
+            the scaling factor in the x and y axis, see scale_factors
+    Returns:
+        size: integer
+            the size of the axis after scaling
+    """
+    if xy_scale <= 1:
+        xy_step = int(np.round(1.0 / xy_scale))
+        return -(-size // xy_step)
+    return int(np.ceil(size * xy_scale))
 
 def mean_photons(fluorophore, exposure_time, objective_efficiency,\
                 detector_efficiency, objective_back_aperture, objective_factor, \
@@ -28,26 +28,58 @@
 output.py
 
 Handles storage of simulation outputs.
-Simulation stacks can be saved in three possible formats:
+Simulation stacks can be saved in five possible formats:
     - TIFF stack
     - GIF stack
     - Image sequence (png)
+    - Zarr (v2) directory of compressed chunks, which can be read crop by crop,
+      see load_zarr
+    - NPY file, which can be memory mapped
 In addition, one can also merge channels into rgb volumes or save each channel
 separatly.
 
 Ground truth is stored on a per-channel basis, and cells can be put in the same volume
 or separated in a volume for each cell. This is useful when the expansion factor is small
 and there is overlap.
+
+Both can be saved in background threads while the simulation is running,
+see ChannelWriter and BackgroundTask. TIFF, GIF and image sequence stacks can
+also be saved slice by slice, see WRITER_CLASS.
 """
 
 import os
-from tifffile import imsave
-from scipy.misc import imresize
+import sys
+import errno
+import json
+import zlib
+import struct
+import shutil
+import threading
+from io import BytesIO
+from Queue import Queue
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from tifffile import imsave, TiffWriter
 import numpy as np
 from PIL import Image
-from images2gif import writeGif
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+#Volumes larger than this (in bytes) are always saved as BigTIFF,
+#standard TIFF offsets are limited to 4 GB
+BIGTIFF_SIZE = 2**32 - 2**25
+#Range of compression levels accepted by each codec. zlib level 0 is excluded,
+#tifffile treats it as no compression
+COMPRESSION_LEVELS = {'zlib': (1, 9), 'zstd': (1, 22)}
+#Size of the GIF header, before the global color table
+GIF_HEADER_SIZE = 13
+#Color table of grayscale GIF frames, each gray level is kept exactly
+GIF_GRAY_PALETTE = ''.join(chr(i) * 3 for i in range(256))
 
-def save_as_tiff(volume, path, name, rgb):
+def save_as_tiff(volume, path, name, rgb, compression='none', compression_level=6,
+                 tile_size=0, bigtiff=False, **kwargs):
     """
     Saves the given volume at location path/name in TIFF format.
 
@@ -60,14 +92,66 @@ def save_as_tiff(volume, path, name, rgb):
             the name of the output volume
         rgb: boolean
             whether to save the volume as an RGB stack or a single channel stack
+        compression: string, 'none', 'zlib' or 'zstd'
+            the lossless compression to use, zstd requires the imagecodecs package
+        compression_level: integer
+            the compression level, from 1 to 9 for zlib and 1 to 22 for zstd
+        tile_size: integer
+            if not 0, slices are saved in square tiles of this size (a multiple of 16),
+            otherwise in strips
+        bigtiff: boolean
+            whether to always save a BigTIFF file, otherwise only volumes larger than
+            BIGTIFF_SIZE are saved as BigTIFF
     """
     dest = path + name + '.tiff'
-    if rgb:
-        imsave(dest, volume, photometric='rgb')
-    else:
-        imsave(dest, volume, photometric='minisblack')
+    options = tiff_options(rgb, compression, compression_level, tile_size)
+    if bigtiff or volume.nbytes > BIGTIFF_SIZE:
+        options['bigtiff'] = True
+    imsave(dest, volume, **options)
 
-def save_as_gif(volume, path, name, rgb):
+def tiff_options(rgb, compression, compression_level, tile_size):
+    """
+    Converts the output parameters to tifffile options, see save_as_tiff.
+
+    Args:
+        rgb, compression, compression_level, tile_size:
+            see save_as_tiff
+    Returns:
+        options: dict
+            the keyword arguments of tifffile's imsave
+    """
+    check_compression(compression, compression_level, tile_size)
+    options = {'photometric': 'rgb' if rgb else 'minisblack'}
+    if compression == 'zlib':
+        options['compress'] = compression_level
+    elif compression == 'zstd':
+        options['compress'] = ('ZSTD', compression_level)
+    if tile_size > 0:
+        options['tile'] = (tile_size, tile_size)
+    return options
+
+def check_compression(compression='none', compression_level=6, tile_size=0, **kwargs):
+    """
+    Checks that the compression and tiling output parameters can be used,
+    so that errors are raised before the simulation runs rather than when saving.
+
+    Args:
+        compression, compression_level, tile_size:
+            see save_as_tiff
+        kwargs:
+            the other output parameters, ignored
+    """
+    if compression in COMPRESSION_LEVELS:
+        low, high = COMPRESSION_LEVELS[compression]
+        if not low <= compression_level <= high:
+            raise ValueError("{} compression level must be between {} and {}, got {}".format(\
+                             compression, low, high, compression_level))
+    if compression == 'zstd' and imagecodecs is None:
+        raise ImportError("zstd compression requires the imagecodecs package")
+    if tile_size % 16 != 0:
+        raise ValueError("tile_size must be a multiple of 16, got {}".format(tile_size))
+
+def save_as_gif(volume, path, name, rgb, **kwargs):
     """
     Saves the given volume at location path/name in GIF format.
 
@@ -81,11 +165,47 @@ def save_as_gif(volume, path, name, rgb):
         rgb: boolean
             whether to save the volume as an RGB stack or a single channel stack
     """
-    dest = path + name + '.gif'
-    sequence = [np.squeeze(volume[i]) for i in range(volume.shape[0])]
-    writeGif(dest, sequence, duration=0.5)
+    with GifStackWriter(path, name, rgb, duration=0.5) as writer:
+        writer.append(volume)
+
+def save_image(args):
+    """
+    Saves a slice as a PNG image, used by save_as_image_sequence.
+
+    Args:
+        args: (im_path, image, rgb, compression_level) tuple
+            the destination of the image, the 2D slice, whether it is an RGB slice
+            and the PNG compression level
+    """
+    im_path, image, rgb, compression_level = args
+    if rgb:
+        #'RGB' saves volume as rgb images, PIL only supports 8 bits rgb images
+        im = Image.fromarray(to_uint8(image), 'RGB')
+    elif image.dtype == np.uint16:
+        #'I;16' is used to save 16 bits images
+        im = Image.fromarray(image, 'I;16')
+    else:
+        #'L' is used to save integer images
+        im = Image.fromarray(image, 'L')
+    im.save(im_path, compress_level=compression_level)
 
-def save_as_image_sequence(volume, path, name, rgb):
+def to_uint8(image):
+    """
+    Converts 16 bits images to 8 bits by keeping the most significant byte,
+    for formats which do not support 16 bits images.
+
+    Args:
+        image: numpy array
+            the image to convert
+    Returns:
+        out: numpy array
+            the 8 bits image, or the image itself if it is not 16 bits
+    """
+    if image.dtype == np.uint16:
+        return (image >> 8).astype(np.uint8)
+    return image
+
+def save_as_image_sequence(volume, path, name, rgb, compression_level=6, processes=1, **kwargs):
     """
     Saves the given volume at location path/name in a sequence of PNG images,
     with an image for each slice.
@@ -99,58 +219,603 @@ def save_as_image_sequence(volume, path, name, rgb):
             the name of the output volume
         rgb: boolean
             whether to save the volume as an RGB stack or a single channel stack
+        compression_level: integer
+            the PNG compression level, from 0 to 9
+        processes: integer
+            the number of processes encoding the images
     """
-    sequence = [np.squeeze(volume[i]) for i in range(volume.shape[0])]
-    digits = np.floor(np.log10(volume.shape[0]))
     dest = path + name
     if not os.path.isdir(dest):
         os.mkdir(dest)
-    for i in range(volume.shape[0]):
-        #Compute appropriate number of 0's to add in front of the slice number
-        suffix = int(digits - np.floor(np.log10(i))) * '0' if i > 0 else int(digits) * '0'
-        im_path = dest + '/image_' + suffix + str(i) + '.png'
-        if rgb:
-            #'RGB' saves volume as rgb images
-            im = Image.fromarray(np.squeeze(volume[i]), 'RGB')
-        else:
-            #'L' is used to save integer images
-            im = Image.fromarray(np.squeeze(volume[i]), 'L')
-        im.save(im_path)
+    #Slice numbers are padded with 0's to the number of digits of the number of slices
+    digits = len(str(volume.shape[0]))
+    tasks = ((dest + '/image_' + str(i).zfill(digits) + '.png', np.squeeze(volume[i]), rgb,\
+              min(compression_level, 9)) for i in range(volume.shape[0]))
+    if processes <= 1:
+        for task in tasks:
+            save_image(task)
+        return
+    pool = Pool(processes)
+    try:
+        for _ in pool.imap_unordered(save_image, tasks, chunksize=4):
+            pass
+    finally:
+        pool.terminate()
+        pool.join()
 
-def merge(volumes):
+def save_as_zarr(volume, path, name, rgb, compression='none', compression_level=6,
+                 chunk_size=(64, 64, 64), threads=1, **kwargs):
+    """
+    Saves the given volume at location path/name in a Zarr (v2) directory:
+    the volume is split in chunks of fixed size, each compressed in a separate file,
+    and the metadata is stored in JSON format in a .zarray file.
+    Chunks which only contain zeros are not saved.
+    The volume can be read with load_zarr or with the zarr package.
+
+    Args:
+        volume: 3D array (z, x, y)
+            the volume to save
+        path: string
+            location to use to save the volume
+        name: string
+            the name of the output volume
+        rgb: boolean
+            whether the volume is an RGB stack (z, x, y, channel), the channels of a voxel
+            are always in the same chunk
+        compression: string, 'none', 'zlib' or 'zstd'
+            the lossless compression of the chunks, zstd requires the imagecodecs package
+        compression_level: integer
+            the compression level, from 1 to 9 for zlib and 1 to 22 for zstd
+        chunk_size: (z, x, y) integer tuple
+            the shape of the chunks
+        threads: integer
+            the number of chunks compressed concurrently
+    """
+    check_compression(compression, compression_level)
+    dest = path + name + '.zarr/'
+    #Remove the chunks of a previous volume
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+    os.mkdir(dest)
+    chunks = tuple(chunk_size) + volume.shape[3:]
+    if compression == 'zlib':
+        compress = lambda data: zlib.compress(data, compression_level)
+    elif compression == 'zstd':
+        compress = lambda data: imagecodecs.zstd_encode(data, compression_level)
+    else:
+        compress = lambda data: data
+    metadata = {'zarr_format': 2,
+                'shape': list(volume.shape),
+                'chunks': list(chunks),
+                'dtype': volume.dtype.str,
+                'compressor': None if compression == 'none' else\
+                              {'id': compression, 'level': compression_level},
+                'fill_value': 0,
+                'order': 'C',
+                'filters': None}
+    with open(dest + '.zarray', 'w') as f:
+        json.dump(metadata, f, indent=4, sort_keys=True)
+
+    def save_chunk(index):
+        block = volume[tuple(slice(i * c, (i + 1) * c) for i, c in zip(index, chunks))]
+        if not block.any():
+            return
+        #Chunks at the border are padded to the full chunk shape
+        if block.shape != chunks:
+            padded = np.zeros(chunks, volume.dtype)
+            padded[tuple(slice(0, s) for s in block.shape)] = block
+            block = padded
+        with open(dest + '.'.join(str(i) for i in index), 'wb') as f:
+            f.write(compress(np.ascontiguousarray(block).tostring()))
+    grid = [-(-s // c) for s, c in zip(volume.shape, chunks)]
+    thread_map(save_chunk, list(np.ndindex(*grid)), threads)
+
+def load_zarr(path, start=None, stop=None):
     """
-    Merges the given volumes into multiple 3 channel (RGB) volumes
+    Loads a crop of a volume saved with save_as_zarr, only the chunks
+    overlapping the crop are read.
 
     Args:
-        volumes: list of numpy 3D arrays
-            list of volumes to break up and stack into multiple 3-channels stacks
+        path: string
+            the path of the .zarr directory
+        start: (z, x, y) integer tuple
+            the first voxel of the crop, defaults to (0, 0, 0)
+        stop: (z, x, y) integer tuple
+            the end of the crop (excluded), defaults to the shape of the volume
     Returns:
-        out: list of numpy 4D arrays (z, x, y, channel)
-            list of rgb volumes
-    """
-    out = []
-    #Add missing channels to round up to % 3
-    num_empty = 0 if len(volumes) % 3 == 0 else 3 - len(volumes) % 3
-    for i in xrange(num_empty):
-        empty = np.zeros_like(volumes[0])
-        volumes.append(empty)
-    #Split every 3 stacks
-    for i in xrange(0, len(volumes), 3):
-        vol = np.stack(volumes[i:i+3], axis = -1)
-        out.append(vol.astype(np.uint8))
+        out: numpy array
+            the crop of the volume
+    """
+    if path[-1] != "/": path += "/"
+    with open(path + '.zarray') as f:
+        metadata = json.load(f)
+    shape, chunks = metadata['shape'], metadata['chunks']
+    dtype = np.dtype(metadata['dtype'])
+    compressor = metadata['compressor']
+    if compressor is None:
+        decompress = lambda data: data
+    elif compressor['id'] == 'zlib':
+        decompress = zlib.decompress
+    else:
+        if imagecodecs is None:
+            raise ImportError("zstd compression requires the imagecodecs package")
+        decompress = imagecodecs.zstd_decode
+    #Crops are only done on the (z, x, y) axes
+    start = list(start if start is not None else [0] * 3) + [0] * (len(shape) - 3)
+    stop = list(stop if stop is not None else shape[:3]) + shape[3:]
+    out = np.zeros([b - a for a, b in zip(start, stop)], dtype)
+    first = [a // c for a, c in zip(start, chunks)]
+    last = [-(-b // c) for b, c in zip(stop, chunks)]
+    for index in np.ndindex(*[l - f for f, l in zip(first, last)]):
+        index = [i + f for i, f in zip(index, first)]
+        chunk_path = path + '.'.join(str(i) for i in index)
+        #Missing chunks only contain zeros
+        if not os.path.isfile(chunk_path):
+            continue
+        with open(chunk_path, 'rb') as f:
+            block = np.frombuffer(decompress(f.read()), dtype).reshape(chunks)
+        #Intersection of the chunk and the crop
+        lower = [max(i * c, a) for i, c, a in zip(index, chunks, start)]
+        upper = [min((i + 1) * c, b) for i, c, b in zip(index, chunks, stop)]
+        out[tuple(slice(l - a, u - a) for l, u, a in zip(lower, upper, start))] =\
+            block[tuple(slice(l - i * c, u - i * c) for l, u, i, c in zip(lower, upper, index, chunks))]
     return out
 
-#The three possible saving methods
+def save_as_npy(volume, path, name, rgb, **kwargs):
+    """
+    Saves the given volume at location path/name in NPY format.
+    The volume can be read crop by crop with numpy.load(..., mmap_mode='r').
+
+    Args:
+        volume: 3D array (z, x, y)
+            the volume to save
+        path: string
+            location to use to save the volume
+        name: string
+            the name of the output volume
+        rgb: boolean
+            whether the volume is an RGB stack (z, x, y, channel)
+    """
+    np.save(path + name + '.npy', volume)
+
+def merge(volumes):
+    """
+    Merges the given volumes into multiple 3 channel (RGB) volumes.
+    Each volume is copied into the rgb volume as soon as it arrives,
+    and each rgb volume is yielded once its 3 channels are filled.
+
+    Args:
+        volumes: iterable of numpy 3D arrays
+            volumes to break up and stack into multiple 3-channels stacks
+    Returns:
+        out: generator of numpy 4D arrays (z, x, y, channel)
+            the rgb volumes, missing channels of the last one are left empty
+    """
+    rgb = None
+    for i, vol in enumerate(volumes):
+        if i % 3 == 0:
+            rgb = rgb_buffer(vol.shape, vol.dtype)
+        rgb[..., i % 3] = vol
+        if i % 3 == 2:
+            yield rgb
+            rgb = None
+    if rgb is not None:
+        yield rgb
+
+def rgb_buffer(shape, dtype=np.uint8):
+    """
+    Allocates an empty RGB volume, in which channels are copied one at a time.
+
+    Args:
+        shape: (z, x, y) integer tuple
+            the shape of a channel
+        dtype: numpy type
+            the type of the channels, np.uint8 or np.uint16
+    Returns:
+        out: numpy 4D array (z, x, y, channel)
+            the rgb volume, filled with zeros
+    """
+    #Zeroed memory is only committed when it is written
+    if dtype != np.uint16:
+        dtype = np.uint8
+    return np.zeros(tuple(shape) + (3,), dtype)
+
+def downsample_image(volume):
+    """
+    Halves the resolution of an image volume along x and y, each voxel
+    is the mean of a 2 x 2 block, rounded to the nearest integer.
+    The last row or column is repeated if the size is odd.
+
+    Args:
+        volume: numpy 3D or 4D integer array (z, x, y) or (z, x, y, channel)
+            the volume to downsample
+    Returns:
+        out: numpy 3D or 4D integer array
+            the downsampled volume, with the same type
+    """
+    blocks = pyramid_blocks(volume)
+    total = blocks.sum(axis=3, dtype=np.uint32 if volume.dtype.itemsize <= 2 else np.uint64)
+    return ((total + 2) // 4).astype(volume.dtype)
+
+def downsample_labels(volume, method='mode'):
+    """
+    Halves the resolution of a label volume along x and y, labels are not averaged.
+
+    Args:
+        volume: numpy 3D integer array (z, x, y)
+            the labels to downsample
+        method: string, 'mode' or 'stride'
+            if mode, each voxel takes the most frequent label of its 2 x 2 block
+            (the first of the block in case of a tie), if stride, the first one
+    Returns:
+        out: numpy 3D integer array
+            the downsampled labels
+    """
+    if method == 'stride':
+        return np.ascontiguousarray(volume[:, ::2, ::2])
+    blocks = pyramid_blocks(volume)
+    #Number of occurences of each label of the block in the block
+    counts = (blocks[..., :, np.newaxis] == blocks[..., np.newaxis, :]).sum(axis=-1)
+    first = np.argmax(counts, axis=-1)[..., np.newaxis]
+    return np.take_along_axis(blocks, first, axis=-1)[..., 0]
+
+def pyramid_blocks(volume):
+    """
+    Groups the voxels of a volume in 2 x 2 blocks along x and y, see downsample_image.
+
+    Args:
+        volume: numpy 3D or 4D array (z, x, y) or (z, x, y, channel)
+            the volume to split in blocks
+    Returns:
+        out: numpy 4D or 5D array (z, x / 2, y / 2, 4) or (z, x / 2, y / 2, 4, channel)
+            the 4 voxels of each block
+    """
+    pad = [(0, 0), (0, volume.shape[1] % 2), (0, volume.shape[2] % 2)] + [(0, 0)] * (volume.ndim - 3)
+    if volume.shape[1] % 2 or volume.shape[2] % 2:
+        volume = np.pad(volume, pad, mode='edge')
+    z, x, y = volume.shape[:3]
+    blocks = volume.reshape((z, x // 2, 2, y // 2, 2) + volume.shape[3:])
+    blocks = np.moveaxis(blocks, 2, 3)
+    return blocks.reshape((z, x // 2, y // 2, 4) + volume.shape[3:])
+
+def save_pyramid(sf, volume, path, name, rgb, labels, pyramid_levels=0,
+                 pyramid_labels='mode', **kwargs):
+    """
+    Saves a volume with the given save function, followed by the levels of its resolution
+    pyramid: level k is saved as name_{2^k}x, and is downsampled by 2 along x and y from
+    level k - 1.
+
+    Args:
+        sf: function
+            the save function, see SAVE_FUNCTION
+        volume, path, name, rgb:
+            see save_as_tiff
+        labels: boolean
+            whether the volume contains labels (ground truth) or an image
+        pyramid_levels: integer
+            the number of downsampled levels to save
+        pyramid_labels: string, 'mode' or 'stride'
+            how labels are downsampled, see downsample_labels
+        kwargs:
+            the other output parameters, passed to the save function
+    """
+    sf(volume, path, name, rgb, **kwargs)
+    for level in range(1, pyramid_levels + 1):
+        if labels:
+            volume = downsample_labels(volume, pyramid_labels)
+        else:
+            volume = downsample_image(volume)
+        sf(volume, path, '{}_{}x'.format(name, 2**level), rgb, **kwargs)
+
+def thread_map(function, items, threads):
+    """
+    Applies the function to each of the items, using the given number of threads.
+    Compression and disk writes release the GIL, so files can be saved concurrently.
+
+    Args:
+        function: function
+            the function to apply
+        items: list
+            the arguments of each call
+        threads: integer
+            the number of threads to use
+    Returns:
+        out: list
+            the results of each call, in order
+    """
+    if threads <= 1 or len(items) <= 1:
+        return map(function, items)
+    pool = ThreadPool(min(threads, len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+#The possible saving methods
 SAVE_FUNCTION = {'tiff': save_as_tiff,\
                  'gif': save_as_gif,\
-                 'image sequence': save_as_image_sequence}
+                 'image sequence': save_as_image_sequence,\
+                 'zarr': save_as_zarr,\
+                 'npy': save_as_npy}
+
+def as_slab(data, rgb):
+    """
+    Adds the z axis to a single slice, so that slices and z-slabs can be appended
+    the same way to a stack writer.
+
+    Args:
+        data: numpy 2D, 3D or 4D array
+            a slice (x, y) or a z-slab (z, x, y), with an additional channel axis if rgb
+        rgb: boolean
+            whether the data is rgb
+    Returns:
+        out: numpy 3D or 4D array
+            the data as a z-slab
+    """
+    if data.ndim == (3 if rgb else 2):
+        return data[np.newaxis]
+    return data
+
+class StackWriter(object):
+    """
+    Base class of the writers which save a stack incrementally: slices or z-slabs
+    are appended in order, and the file is finalised by close. Only the appended data
+    needs to be in memory. Writers can be used as context managers.
+    """
+
+    def append(self, data):
+        """
+        Appends slices to the stack.
+
+        Args:
+            data: numpy 2D, 3D or 4D array
+                a slice (x, y) or a z-slab (z, x, y), with an additional channel axis
+                if the stack is rgb
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Finalises the stack, nothing can be appended afterwards.
+        """
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class TiffStackWriter(StackWriter):
+    """
+    Saves a stack in TIFF format, one page per slice, see save_as_tiff.
+    Uncompressed stacks saved in strips are stored contiguously, and their shape
+    is written at close. Compressed or tiled stacks are stored as a plain
+    sequence of pages, which is read as a single (z, x, y) stack.
+    """
+
+    def __init__(self, path, name, rgb, compression='none', compression_level=6,
+                 tile_size=0, bigtiff=False, **kwargs):
+        """
+        Args:
+            path, name, rgb, compression, compression_level, tile_size:
+                see save_as_tiff
+            bigtiff: boolean
+                whether to save a BigTIFF file, the size of the stack is not known
+                in advance so this is needed for stacks larger than BIGTIFF_SIZE
+        """
+        self.rgb = rgb
+        self.options = tiff_options(rgb, compression, compression_level, tile_size)
+        if 'compress' in self.options or 'tile' in self.options:
+            #Pages cannot be contiguous, the shape of the first one would be used for the stack
+            self.options['metadata'] = None
+        self.tiff = TiffWriter(path + name + '.tiff', bigtiff=bigtiff)
+
+    def append(self, data):
+        #Contiguous pages are only appended one slice at a time
+        for image in as_slab(data, self.rgb):
+            self.tiff.save(image, **self.options)
+
+    def close(self):
+        self.tiff.close()
+
+class ImageSequenceWriter(StackWriter):
+    """
+    Saves a stack in a sequence of PNG images, see save_as_image_sequence.
+    Images are named by their slice number at close, when the number of slices is known.
+    """
+
+    def __init__(self, path, name, rgb, compression_level=6, processes=1, **kwargs):
+        """
+        Args:
+            path, name, rgb, compression_level, processes:
+                see save_as_image_sequence
+        """
+        self.dest = path + name
+        if not os.path.isdir(self.dest):
+            os.mkdir(self.dest)
+        self.rgb = rgb
+        self.compression_level = min(compression_level, 9)
+        self.processes = processes
+        self.pool = Pool(processes) if processes > 1 else None
+        self.pending = []
+        self.count = 0
+
+    def append(self, data):
+        data = as_slab(data, self.rgb)
+        tasks = [(self.dest + '/image_' + str(self.count + i) + '.png', data[i], self.rgb,\
+                  self.compression_level) for i in range(data.shape[0])]
+        self.count += len(tasks)
+        if self.pool is None:
+            map(save_image, tasks)
+            return
+        self.pending.append(self.pool.map_async(save_image, tasks))
+        #Limit the number of slabs waiting to be encoded
+        while len(self.pending) > self.processes:
+            self.pending.pop(0).get()
+
+    def close(self):
+        if self.pool is not None:
+            try:
+                for result in self.pending:
+                    result.get()
+            finally:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+        #Pad slice numbers with 0's, as save_as_image_sequence
+        digits = len(str(self.count))
+        for i in range(self.count):
+            os.rename(self.dest + '/image_' + str(i) + '.png',\
+                      self.dest + '/image_' + str(i).zfill(digits) + '.png')
+
+class GifStackWriter(StackWriter):
+    """
+    Saves a stack in an animated GIF, see save_as_gif. Only the rectangle which changed
+    since the previous frame is saved. Grayscale frames use a fixed 256 level gray color
+    table. RGB frames are quantized to their own color table, and the most frequent
+    color table is written as global color table at close.
+    """
+
+    def __init__(self, path, name, rgb, duration=0.5, **kwargs):
+        """
+        Args:
+            path, name, rgb:
+                see save_as_gif
+            duration: float
+                the duration of each frame, in seconds
+        """
+        self.rgb = rgb
+        self.duration = duration
+        self.file = open(path + name + '.gif', 'wb')
+        self.previous = None
+        #Color tables of RGB frames and their number of frames, in order of appearance
+        self.palettes = []
+        self.counts = {}
+
+    def append(self, data):
+        for image in as_slab(data, self.rgb):
+            image = to_uint8(np.squeeze(image)).astype(np.uint8)
+            #Bounding box of the changes since the previous frame
+            if self.previous is None:
+                x0, x1, y0, y1 = 0, image.shape[0], 0, image.shape[1]
+            else:
+                diff = image != self.previous
+                if diff.ndim == 3:
+                    diff = diff.any(axis=2)
+                rows, cols = np.flatnonzero(diff.any(axis=1)), np.flatnonzero(diff.any(axis=0))
+                if rows.size:
+                    x0, x1, y0, y1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+                else:
+                    x0, x1, y0, y1 = 0, 1, 0, 1
+            header = self.previous is None
+            self.previous = image
+            crop = np.ascontiguousarray(image[x0:x1, y0:y1])
+            if self.rgb:
+                im = Image.fromarray(crop, 'RGB').convert('P', palette=Image.ADAPTIVE, colors=256)
+            else:
+                im = Image.frombytes('P', (crop.shape[1], crop.shape[0]), crop.tobytes())
+                im.putpalette(GIF_GRAY_PALETTE)
+            palette, lzw = gif_image_data(im)
+            if header:
+                #Header, global color table (written again at close for RGB) and infinite looping
+                self.file.write('GIF89a' + struct.pack('<2H', image.shape[1], image.shape[0]) +\
+                                '\x87\x00\x00')
+                self.file.write(palette if self.rgb else GIF_GRAY_PALETTE)
+                self.file.write('\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+            #Frame duration, the frame is left in place
+            self.file.write('\x21\xf9\x04\x04' + struct.pack('<H', int(self.duration * 100)) +\
+                            '\x00\x00')
+            #Image descriptor, RGB frames have a local color table
+            self.file.write(',' + struct.pack('<4H', y0, x0, y1 - y0, x1 - x0))
+            if self.rgb:
+                if palette not in self.counts:
+                    self.palettes.append(palette)
+                    self.counts[palette] = 0
+                self.counts[palette] += 1
+                self.file.write('\x87' + palette)
+            else:
+                self.file.write('\x00')
+            self.file.write(lzw)
+
+    def close(self):
+        try:
+            self.file.write(';')
+            if self.palettes:
+                self.file.seek(GIF_HEADER_SIZE)
+                self.file.write(max(self.palettes, key=lambda p: self.counts[p]))
+        finally:
+            self.file.close()
+
+def gif_image_data(im):
+    """
+    Encodes a palette image as a single frame GIF with PIL, and reads
+    its color table and compressed image data back following the GIF format.
+
+    Args:
+        im: PIL image
+            the image to encode, in 'P' mode
+    Returns:
+        palette: string
+            the color table of the image, padded to 256 colors
+        lzw: string
+            the LZW minimum code size followed by the image data sub-blocks
+    """
+    buf = BytesIO()
+    #Without optimization, PIL keeps the color table and pixel values as they are.
+    #Frames are written without interlacing, which PIL enables by default
+    im.save(buf, 'GIF', optimize=False, interlace=False)
+    gif = buf.getvalue()
+    palette = ''
+    flags = ord(gif[10])
+    pos = GIF_HEADER_SIZE
+    if flags & 0x80:
+        size = 3 * 2 ** ((flags & 7) + 1)
+        palette, pos = gif[pos:pos + size], pos + size
+    #Skip extension blocks until the image descriptor
+    while gif[pos] == '!':
+        pos += 2
+        while gif[pos] != '\0':
+            pos += ord(gif[pos]) + 1
+        pos += 1
+    flags = ord(gif[pos + 9])
+    pos += 10
+    if flags & 0x80:
+        size = 3 * 2 ** ((flags & 7) + 1)
+        palette, pos = gif[pos:pos + size], pos + size
+    #The image data ends with an empty sub-block, after the LZW minimum code size
+    end = pos + 1
+    while gif[end] != '\0':
+        end += ord(gif[end]) + 1
+    return palette.ljust(768, '\0'), gif[pos:end + 1]
+
+#The stack writers of each format
+WRITER_CLASS = {'tiff': TiffStackWriter,\
+                'gif': GifStackWriter,\
+                'image sequence': ImageSequenceWriter}
+
+def make_dir(path):
+    """
+    Creates a directory and its missing parents. Simulation and ground truth are
+    saved concurrently, so the directory may be created by another thread meanwhile.
+
+    Args:
+        path: string
+            the directory to create
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
 
 def save(volumes, path, name, sim_channels, format, **kwargs):
     """
     Saves the simulation stack with the given output parameters.
 
     Args:
-        volumes: list of numpy 3D uint8 arrays
+        volumes: list of numpy 3D uint8 or uint16 arrays
             list of volumes to store, one for each channel
         path: string
             the destination path
@@ -159,30 +824,125 @@ def save(volumes, path, name, sim_channels, format, **kwargs):
         sim_channels: string ('merged' or 'splitted')
             whether to store each channel in a separate stack or
             create an RGB stack for every sequence of 3 volumes
-        format: string ('tiff', 'gif' or 'image sequence')
+        format: string ('tiff', 'gif', 'image sequence', 'zarr' or 'npy')
             the desired output format
+        kwargs:
+            the other output parameters, passed to the save function,
+            see save_as_tiff
+    """
+    save_stream(iter(volumes), path, name, sim_channels, format, **kwargs)
+
+def save_stream(volumes, path, name, sim_channels, format, **kwargs):
+    """
+    Saves the simulation stack like save, but reads the volumes from an iterator
+    and saves each of them as soon as possible: every volume if channels are splitted,
+    every 3 volumes if they are merged. References to saved volumes are dropped,
+    merged volumes are copied into the rgb volume as they arrive.
+
+    Args:
+        volumes: iterator of numpy 3D uint8 or uint16 arrays
+            the volumes to store, one for each channel
+        path, name, sim_channels, format, kwargs:
+            see save
     """
     if path[-1] != "/": path += "/"
-    if not os.path.isdir(path + name):
-        os.mkdir(path + name)
     dest = path + name + '/simulation'
-    if not os.path.isdir(dest): os.mkdir(dest)
+    make_dir(dest)
 
-    i = 0
+    #Get save function
+    sf = SAVE_FUNCTION[format]
     if sim_channels == 'merged':
-        volumes = merge(volumes)
-        for vol in volumes:
-            #Get save function
-            sf = SAVE_FUNCTION[format]
-            #Save 3 at a time
-            sf(vol, dest + '/', 'channels_{}{}{}'.format(i, i + 1, i + 2), True)
-            i += 3
+        #Save the channels 3 at a time, as soon as each rgb volume is filled
+        for i, rgb in enumerate(merge(volumes)):
+            save_pyramid(sf, rgb, dest + '/', 'channels_{}{}{}'.format(3 * i, 3 * i + 1, 3 * i + 2),\
+                         True, False, **kwargs)
     else:
-        for vol in volumes:
-            sf = SAVE_FUNCTION[format]
-            #Save each channel in a different volume
-            sf(vol, dest + '/', 'channel_{}'.format(i), False)
-            i += 1
+        #Save each channel in a different volume
+        for i, vol in enumerate(volumes):
+            save_pyramid(sf, vol, dest + '/', 'channel_{}'.format(i), False, False, **kwargs)
+
+class BackgroundTask(threading.Thread):
+    """
+    Runs a function in a background thread.
+    Exceptions raised by the function are raised again by join.
+    """
+
+    def __init__(self, function, *args, **kwargs):
+        """
+        Args:
+            function: function
+                the function to run
+            args, kwargs:
+                the arguments of the function
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.error = None
+
+    def run(self):
+        try:
+            self.function(*self.args, **self.kwargs)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def join(self):
+        threading.Thread.join(self)
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+class ChannelWriter(BackgroundTask):
+    """
+    Saves simulation channels in a background thread, with save_stream,
+    as they are put in a bounded queue. Putting a channel blocks while
+    max_pending channels are waiting to be saved, which bounds memory usage.
+    """
+
+    def __init__(self, max_pending=1, **output_params):
+        """
+        Args:
+            max_pending: integer
+                the number of channels that can wait to be saved
+            output_params:
+                the output parameters, see save
+        """
+        self.queue = Queue(maxsize=max_pending)
+        BackgroundTask.__init__(self, save_stream, self.channels(), **output_params)
+
+    def channels(self):
+        """
+        Yields the queued channels until close is called.
+        """
+        volume = self.queue.get()
+        while volume is not None:
+            yield volume
+            volume = self.queue.get()
+
+    def run(self):
+        BackgroundTask.run(self)
+        if self.error is not None:
+            #Keep emptying the queue so that put never blocks
+            for _ in self.channels():
+                pass
+
+    def put(self, volume):
+        """
+        Queues a channel to be saved, the channels are saved in order.
+
+        Args:
+            volume: numpy 3D uint8 or uint16 array
+                the channel to save
+        """
+        self.queue.put(volume)
+
+    def close(self):
+        """
+        Waits for all channels to be saved.
+        """
+        self.queue.put(None)
+        self.join()
 
 def save_gt(gt_dataset, labeled_cells, volume_dim, out_dim, voxel_dim, expansion_params,
              optics_params, path, name, gt_cells, gt_region, format, **kwargs):
@@ -204,12 +964,14 @@ def save_gt(gt_dataset, labeled_cells, volume_dim, out_dim, voxel_dim, expansion
             path where to save the ground truth
         name:
             name of the experiment
-        gt_cells: string, 'merged' or 'splitted'
+        gt_cells: string, 'merged', 'splitted' or 'sparse'
             if merged, all the cells' ground truth are in the same volume,
-            if splitted, a new volume is made for each labeled cell
+            if splitted, a new volume is made for each labeled cell,
+            if sparse, the output coordinates of each cell are saved in a cells.npz file,
+            see cell_coordinates
         gt_region: string
             the region of the cell to put in the ground truth
-        format: string 'tiff', 'png' or 'image sequence'
+        format: string 'tiff', 'gif', 'image sequence', 'zarr' or 'npy'
             the format to use to save the data, same format as the simulation output
         expansion_params: dict
             dictionary containing the expansion parameters,
@@ -217,46 +979,130 @@ def save_gt(gt_dataset, labeled_cells, volume_dim, out_dim, voxel_dim, expansion
         optics_params: dict
             dictionary containing the optics parameters,
             used for scaling
+        kwargs:
+            the other output parameters, passed to the save function,
+            threads is the number of cell volumes saved concurrently
     """
     if path[-1] != "/": path += "/"
-    if not os.path.isdir(path + name):
-        os.mkdir(path + name)
     dest = path + name + '/groundtruth/'
-    if not os.path.isdir(dest):
-        os.mkdir(dest)
+    make_dir(dest)
 
     sf = SAVE_FUNCTION[format]
     for fluorophore in labeled_cells:
-        if not os.path.isdir(dest + fluorophore):
-            os.mkdir(dest + fluorophore)
+        make_dir(dest + fluorophore)
         cells = labeled_cells[fluorophore]
         if gt_cells == 'merged':
-            #Merge cells
-            volume = np.zeros(volume_dim, np.uint32)
-            z_step = int(np.ceil(volume.shape[0] / float(out_dim[0])))
-            out = np.zeros(out_dim, np.uint32)
-            for cell in cells:
-                voxels = gt_dataset[cell][gt_region]
-                #Fill volume with cell_id
-                volume[tuple(voxels.transpose())] = int(cell)
-                #Optical resclaing
-                for i in range(0, volume.shape[0], z_step):
-                    resized = imresize(volume[i], (out_dim[1], out_dim[2]), interp='nearest')
-                    resized[np.nonzero(resized)] = int(cell)
-                    out[i // z_step] += resized
-            sf(out, dest + fluorophore + '/', 'all_cells', False)
+            #Merge cells, later cells overwrite earlier ones where they overlap
+            z_step = int(np.ceil(volume_dim[0] / float(out_dim[0])))
+            out = paint_labels(gt_dataset, cells, gt_region, volume_dim, out_dim, z_step)
+            save_pyramid(sf, out, dest + fluorophore + '/', 'all_cells', False, True, **kwargs)
+        elif gt_cells == 'sparse':
+            #Save the output coordinates of each cell in a single file
+            z_step = int(np.round(volume_dim[0] / float(out_dim[0])))
+            coords = dict((str(cell), cell_coordinates(gt_dataset[cell][gt_region], volume_dim,\
+                                                       out_dim, z_step)) for cell in cells)
+            np.savez_compressed(dest + fluorophore + '/cells.npz',\
+                                shape=np.array(out_dim, np.int64), **coords)
         else:
             #Save each cell seperatly
-            for cell in cells:
-                #Create new volume for each cell
-                volume = np.zeros(volume_dim, np.uint32)
-                voxels = gt_dataset[cell][gt_region]
-                volume[tuple(voxels.transpose())] = int(cell)
-                #Optical rescaling
-                z_step = int(np.round(volume.shape[0] / float(out_dim[0])))
+            z_step = int(np.round(volume_dim[0] / float(out_dim[0])))
+            def save_cell(cell):
+                coords = cell_coordinates(gt_dataset[cell][gt_region], volume_dim, out_dim, z_step)
                 out = np.zeros(out_dim, np.uint32)
-                for i in range(0, volume.shape[0], z_step):
-                    out[i // z_step] = imresize(volume[i], (out_dim[1], out_dim[2]), interp='nearest')
-                #This fices a bug in the interpolation which rounds the non zero value to 255
-                out[np.nonzero(out)] = int(cell)
-                sf(out, dest + fluorophore + '/', str(cell), False)
+                out[tuple(coords.transpose())] = int(cell)
+                save_pyramid(sf, out, dest + fluorophore + '/', str(cell), False, True, **kwargs)
+            thread_map(save_cell, list(cells), kwargs.get('threads', 1))
+
+def paint_labels(gt_dataset, cells, gt_region, volume_dim, out_dim, z_step):
+    """
+    Paints the given cells into a label volume of the output shape.
+    Only the planes kept in the output are painted, one every z_step,
+    and they are then rescaled in x and y with nearest neighbour interpolation,
+    like imresize, in a single gather.
+
+    Args:
+        gt_dataset: dict cell_id (string) -> region (string) -> voxels (numpy 2D array)
+            the loaded data, see save_gt
+        cells: list of strings
+            the cell_ids to paint, in order
+        gt_region: string
+            the region of the cells to paint
+        volume_dim: (z, x, y) integer tuple
+            the dimensions of the original volume
+        out_dim: (z, x, y) integer tuple
+            the dimensions of the output volume
+        z_step: integer
+            the number of original planes per output plane
+    Returns:
+        out: numpy 3D uint32 array
+            the label volume, with the cell_id of each voxel or 0
+    """
+    planes = np.arange(0, volume_dim[0], z_step)[:out_dim[0]]
+    #Index of each original plane in the output, -1 if it is not kept
+    z_map = np.full(volume_dim[0], -1, np.int64)
+    z_map[planes] = np.arange(len(planes))
+    volume = np.zeros((len(planes), volume_dim[1], volume_dim[2]), np.uint32)
+    for cell in cells:
+        voxels = np.asarray(gt_dataset[cell][gt_region]).reshape(-1, 3)
+        z = z_map[voxels[:, 0]]
+        kept = z >= 0
+        volume[z[kept], voxels[kept, 1], voxels[kept, 2]] = int(cell)
+    out = np.zeros(out_dim, np.uint32)
+    out[:len(planes)] = volume[:, nearest_indices(volume_dim[1], out_dim[1])]\
+                              [:, :, nearest_indices(volume_dim[2], out_dim[2])]
+    return out
+
+def cell_coordinates(voxels, volume_dim, out_dim, z_step):
+    """
+    Returns the coordinates of the output voxels covered by a cell, when rescaled
+    like paint_labels. Only the bounding box of the cell is painted and rescaled.
+
+    Args:
+        voxels: numpy 2D array (n x 3)
+            the (z, x, y) voxels of the cell in the original volume
+        volume_dim: (z, x, y) integer tuple
+            the dimensions of the original volume
+        out_dim: (z, x, y) integer tuple
+            the dimensions of the output volume
+        z_step: integer
+            the number of original planes per output plane
+    Returns:
+        coords: numpy 2D uint32 array (m x 3)
+            the (z, x, y) coordinates of the cell in the output volume
+    """
+    voxels = np.asarray(voxels).reshape(-1, 3)
+    #Keep the planes sampled in the output, and move them to output planes
+    voxels = voxels[(voxels[:, 0] % z_step == 0) & (voxels[:, 0] // z_step < out_dim[0])]
+    voxels = np.column_stack([voxels[:, 0] // z_step, voxels[:, 1], voxels[:, 2]])
+    if len(voxels) == 0:
+        return np.zeros((0, 3), np.uint32)
+    low, high = voxels.min(axis=0), voxels.max(axis=0)
+    crop = np.zeros(high - low + 1, bool)
+    crop[tuple((voxels - low).transpose())] = True
+    #Output pixels sampling the bounding box, in x and y
+    x = nearest_indices(volume_dim[1], out_dim[1])
+    y = nearest_indices(volume_dim[2], out_dim[2])
+    x_out = np.nonzero((x >= low[1]) & (x <= high[1]))[0]
+    y_out = np.nonzero((y >= low[2]) & (y <= high[2]))[0]
+    sampled = crop[:, x[x_out] - low[1]][:, :, y[y_out] - low[2]]
+    (z, i, j) = np.nonzero(sampled)
+    return np.stack([z + low[0], x_out[i], y_out[j]], axis=1).astype(np.uint32)
+
+def nearest_indices(size, out_size):
+    """
+    Returns the index sampled for each output pixel when resizing an axis
+    with nearest neighbour interpolation, as imresize does.
+
+    Args:
+        size: integer
+            the size of the original axis
+        out_size: integer
+            the size of the resized axis
+    Returns:
+        indices: numpy 1D int64 array
+            the original index of each output pixel
+    """
+    #PIL samples pixel centers by adding up the step, and so does this
+    step = size / float(out_size)
+    centers = np.add.accumulate(np.concatenate([[0.5 * step], np.full(out_size - 1, step)]))
+    return np.minimum(np.floor(centers).astype(np.int64), size - 1)
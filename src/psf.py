@@ -44,7 +44,8 @@ Requirements
 ------------
 * `CPython 2.7 or 3.4 <http://www.python.org>`_
 * `Numpy 1.9 <http://www.numpy.org>`_
-* `Psf.c 2015.03.19 <http://www.lfd.uci.edu/~gohlke/>`_
+* `Psf.c 2015.03.19 <http://www.lfd.uci.edu/~gohlke/>`_  (optional, the
+  _psf_numpy module is used when the extension is not built)
 * `Matplotlib 1.4 <http://www.matplotlib.org>`_  (optional for plotting)
 
 References
@@ -97,16 +98,17 @@ import threading
 
 import numpy
 
+import _psf_numpy
+
 try:
     import _psf
 except ImportError:
-    raise ImportError(
-        "The compiled psf.c extension module could not be found. "
-        "Psf.c can be obtained at http://www.lfd.uci.edu/~gohlke/")
+    # fall back to the slower pure numpy implementation of psf.c
+    _psf = _psf_numpy
 
 __version__ = '2015.03.19'
 __docformat__ = 'restructuredtext en'
-__all__ = 'PSF', 'Pinhole'
+__all__ = 'PSF', 'Pinhole', 'psf_batch'
 
 ANISOTROPIC = 1
 ISOTROPIC = 2
@@ -201,7 +203,7 @@ class PSF(object):
                  ex_wavelen=None, em_wavelen=None, num_aperture=1.2,
                  refr_index=1.333, magnification=1.0, underfilling=1.0,
                  pinhole_radius=None, pinhole_shape='round',
-                 expsf=None, empsf=None, name=None):
+                 expsf=None, empsf=None, name=None, data=None):
         """Initialize the PSF object.
 
         Arguments
@@ -219,6 +221,10 @@ class PSF(object):
             of the pinhole divided by the magnification of the system.
         pinhole_shape : str
             Either 'round' (default) or 'square'.
+        data : 2D array of floats or None
+            Precomputed values of an isotropic excitation or emission PSF
+            in z,r space, e.g. from psf_batch. If specified, the PSF is not
+            calculated.
 
         """
         try:
@@ -314,7 +320,15 @@ class PSF(object):
             self.data = _psf.gaussian2d(self.dims.px, self.sigma.px)
 
         elif psftype & ISOTROPIC:
-            if psftype & EXCITATION or psftype & TWOPHOTON:
+            if data is not None and psftype & (EXCITATION | EMISSION):
+                if psftype & EXCITATION:
+                    self.em_wavelen = None
+                    self.magnification = None
+                else:
+                    self.ex_wavelen = None
+                    self.underfilling = None
+                self.data = numpy.array(data, dtype=numpy.float64)
+            elif psftype & EXCITATION or psftype & TWOPHOTON:
                 self.em_wavelen = None
                 self.magnification = None
                 self.data = _psf.psf(0, self.shape, self.dims.ou, 1.0,
@@ -579,6 +593,55 @@ class Dimensions(dict):
         return ", ".join(s)
 
 
+def psf_batch(psftype, wavelengths, shape=(256, 256), dims=(4., 4.),
+              num_aperture=1.2, refr_index=1.333, magnification=1.0,
+              underfilling=1.0):
+    """Return isotropic excitation or emission PSFs for several wavelengths.
+
+    The PSFs of all wavelengths are calculated in one vectorized call, which
+    is much faster than one PSF object (and thread) per wavelength.
+
+    Arguments
+    ---------
+    psftype : int
+        Either EXCITATION or EMISSION.
+    wavelengths : sequence of float
+        Excitation or emission wavelengths in *nanometers*.
+    shape, dims, num_aperture, refr_index, magnification, underfilling :
+        See PSF.__init__.
+
+    Examples
+    --------
+    >>> args = dict(shape=(32, 32), dims=(4, 4), num_aperture=1.2,
+    ...             refr_index=1.333)
+    >>> psfs = psf_batch(EMISSION, [520, 600], **args)
+    >>> numpy.allclose(psfs[1].data, PSF(ISOTROPIC | EMISSION,
+    ...                                  em_wavelen=600, **args).data)
+    True
+
+    """
+    if psftype not in (EXCITATION, EMISSION):
+        raise ValueError("PSF type must be EXCITATION or EMISSION")
+    sinalpha = num_aperture / refr_index
+    dims = float(dims[0]), float(dims[1])
+    if psftype == EXCITATION:
+        uvdims = [zr2uv(dims, w / 1e3, sinalpha, refr_index, 1.0)
+                  for w in wavelengths]
+        data = _psf_numpy.psf_batch(0, shape, uvdims, 1.0, sinalpha,
+                                    underfilling, 1.0, 80)
+        wavelen = 'ex_wavelen'
+    else:
+        uvdims = [zr2uv(dims, w / 1e3, sinalpha, refr_index, magnification)
+                  for w in wavelengths]
+        data = _psf_numpy.psf_batch(1, shape, uvdims, magnification,
+                                    sinalpha, 1.0, 1.0, 80)
+        wavelen = 'em_wavelen'
+    return [PSF(ISOTROPIC | psftype, shape, dims, num_aperture=num_aperture,
+                refr_index=refr_index, magnification=magnification,
+                underfilling=underfilling, data=d, **{wavelen: w})
+            for w, d in zip(wavelengths, data)]
+
+
 def uv2zr(uv, wavelength, sinalpha, refr_index, magnification=1.0):
     """Return z,r in units of the wavelength from u,v given in optical units.
 